@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Notspam benchmark harness
+
+Generates a reproducible synthetic notmuch database, and measures
+throughput and per-message latency of notspam.train() and
+notspam.classify() under each classifier backend.  External
+classifier programs are replaced by the stub in bench/stub, and spamd
+by a fake in-process spamd server, all with controllable latency.
+
+Results are written as JSON, for comparison between commits:
+
+  python3 bench/bench.py -n 2000 --output=bench.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import notmuch
+import notspam
+
+STUB = os.path.join(BENCH_DIR, 'stub')
+DEFAULT_BACKENDS = ['null', 'native', 'bogofilter', 'bsfilter', 'sylfilter', 'spamassassin']
+WORDS = {
+    'spam': ['viagra', 'winner', 'prize', 'cheap', 'offer', 'casino', 'free', 'click',
+             'unsubscribe', 'bitcoin', 'loan', 'urgent'],
+    'ham': ['meeting', 'patch', 'review', 'lunch', 'release', 'notmuch', 'thread',
+            'agenda', 'draft', 'commit', 'tomorrow', 'thanks'],
+    }
+
+############################################################
+
+def _sizes(spec, rand):
+    """Message body size generator from '<dist>:<params>' spec.
+
+    fixed:<bytes>, uniform:<min>:<max>, or lognormal:<mu>:<sigma>.
+
+    """
+    dist, _, params = spec.partition(':')
+    params = [float(p) for p in params.split(':') if p]
+    if dist == 'fixed':
+        return lambda: int(params[0])
+    elif dist == 'uniform':
+        return lambda: rand.randint(int(params[0]), int(params[1]))
+    elif dist == 'lognormal':
+        return lambda: int(rand.lognormvariate(params[0], params[1]))
+    raise ValueError("unknown size distribution '%s'" % dist)
+
+def make_corpus(path, nmsgs, sizes, spam_ratio, seed):
+    """Create maildir of synthetic messages, and index it in notmuch.
+
+    Returns a dict mapping meat to the query string matching the
+    messages of that meat.
+
+    """
+    rand = random.Random(seed)
+    size = _sizes(sizes, rand)
+    cur = os.path.join(path, 'mail', 'cur')
+    for d in ['cur', 'new', 'tmp']:
+        os.makedirs(os.path.join(path, 'mail', d))
+    files = []
+    for n in range(nmsgs):
+        meat = 'spam' if rand.random() < spam_ratio else 'ham'
+        words = WORDS[meat] + WORDS['ham' if meat == 'spam' else 'spam'][:2]
+        body = []
+        length = 0
+        target = max(size(), 1)
+        while length < target:
+            word = rand.choice(words)
+            body.append(word)
+            length += len(word) + 1
+        filename = os.path.join(cur, '%08d.bench:2,' % n)
+        with open(filename, 'w') as f:
+            f.write('From: %s@%s.example.com\n' % (rand.choice(words), meat))
+            f.write('To: user@example.com\n')
+            f.write('Subject: %s\n' % ' '.join(rand.choice(words) for i in range(4)))
+            f.write('Message-ID: <%08d@bench.example.com>\n' % n)
+            f.write('Date: %s\n' % time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(1400000000 + n * 60)))
+            f.write('X-Bench-Class: %s\n' % meat)
+            f.write('\n')
+            f.write(' '.join(body))
+            f.write('\n')
+        files.append((filename, meat))
+
+    with notmuch.Database(path=os.path.join(path, 'mail'), create=True) as db:
+        for filename, meat in files:
+            if hasattr(db, 'index_file'):
+                msg, status = db.index_file(filename)
+            else:
+                msg, status = db.add_message(filename)
+            msg.add_tag('bench-%s' % meat)
+    return {meat: 'tag:bench-%s' % meat for meat in ['spam', 'ham']}
+
+############################################################
+
+def make_stubs(path):
+    """Directory of stub classifier executables."""
+    bindir = os.path.join(path, 'bin')
+    os.makedirs(bindir)
+    for name in ['bogofilter', 'bsfilter', 'sylfilter', 'sa-learn', 'spamc', 'mailreaver.crm']:
+        os.symlink(STUB, os.path.join(bindir, name))
+    return bindir
+
+class _SpamdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        while True:
+            line = self.rfile.readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.lower()] = value.strip()
+        body = self.rfile.read(int(headers.get('content-length', 0)))
+        time.sleep(self.server.latency)
+        if b'\nX-Bench-Class: spam' in body[:4096]:
+            result = b'True ; 15.0 / 5.0'
+        else:
+            result = b'False ; -1.0 / 5.0'
+        self.wfile.write(b'SPAMD/1.1 0 EX_OK\r\nSpam: ' + result + b'\r\n\r\n')
+
+class FakeSpamd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Fake spamd answering CHECK requests on a unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path, latency=0):
+        super().__init__(path, _SpamdHandler)
+        self.latency = latency
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+############################################################
+
+class _Timed(object):
+    """Classifier module wrapper recording per-message latencies.
+
+    Batch call times are divided evenly among the batch messages.
+
+    """
+    def __init__(self, module):
+        self.__name__ = module.__name__
+        self.latencies = []
+        latencies = self.latencies
+
+        class Trainer(module.Trainer):
+            def add_batch(self, msgs):
+                t = time.perf_counter()
+                try:
+                    return super().add_batch(msgs)
+                finally:
+                    t = (time.perf_counter() - t) / len(msgs)
+                    latencies.extend([t] * len(msgs))
+
+        class Classifier(module.Classifier):
+            def classify_batch(self, msgs):
+                t = time.perf_counter()
+                try:
+                    return super().classify_batch(msgs)
+                finally:
+                    t = (time.perf_counter() - t) / len(msgs)
+                    latencies.extend([t] * len(msgs))
+
+        self.Trainer = Trainer
+        self.Classifier = Classifier
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+def _result(backend, op, nmsgs, seconds, latencies):
+    return {
+        'backend': backend,
+        'op': op,
+        'nmsgs': nmsgs,
+        'seconds': round(seconds, 6),
+        'msgs_per_s': round(nmsgs / seconds, 3) if seconds else None,
+        'p50_ms': round(_percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        }
+
+def bench_backend(name, queries, args):
+    """Train and classify with named backend, returning result dicts."""
+    try:
+        module = _Timed(notspam.import_classifier(name))
+    except (ImportError, AttributeError) as e:
+        print("%s: skipped (%s)" % (name, e), file=sys.stderr)
+        return []
+    results = []
+    for meat in ['spam', 'ham']:
+        module.latencies.clear()
+        t = time.perf_counter()
+        nmsgs = notspam.train(module, meat, queries[meat], dry=True).counts['trained']
+        t = time.perf_counter() - t
+        results.append(_result(name, 'train-%s' % meat, nmsgs, t, module.latencies))
+    module.latencies.clear()
+    t = time.perf_counter()
+    nmsgs = notspam.classify(module, '*', dry=True, cache=False,
+                             batch_size=args.batch, jobs=args.jobs).counts['msgs']
+    t = time.perf_counter() - t
+    results.append(_result(name, 'classify', nmsgs, t, module.latencies))
+    for r in results:
+        print("%(backend)s %(op)s: %(nmsgs)d msgs in %(seconds).2fs (%(msgs_per_s)s msgs/s)"
+              " p50 %(p50_ms)sms p99 %(p99_ms)sms" % r, file=sys.stderr)
+    return results
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark notspam classifier backends.")
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+                        help="number of messages in corpus (default: %(default)s)")
+    parser.add_argument('--sizes', default='lognormal:7.5:1.0',
+                        help="message body size distribution: fixed:<bytes>, uniform:<min>:<max>"
+                        " or lognormal:<mu>:<sigma> (default: %(default)s)")
+    parser.add_argument('--spam-ratio', type=float, default=0.5,
+                        help="fraction of spam messages (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="corpus random seed (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="stub latency per invocation, in seconds (default: %(default)s)")
+    parser.add_argument('--msg-latency', type=float, default=0.0,
+                        help="stub latency per message, in seconds (default: %(default)s)")
+    parser.add_argument('--backends', default=','.join(DEFAULT_BACKENDS),
+                        help="comma-separated backends to benchmark (default: %(default)s)")
+    parser.add_argument('--batch', type=int, default=notspam._DEFAULT_BATCH_SIZE,
+                        help="classify batch size (default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="classify worker threads (default: %(default)s)")
+    parser.add_argument('--output', help="write JSON results to file (default: stdout)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='notspam-bench-') as tmp:
+        bindir = make_stubs(tmp)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['HOME'] = tmp
+        os.environ['MAILDIR'] = os.path.join(tmp, 'mail')
+        os.environ['NOTMUCH_CONFIG'] = os.path.join(tmp, 'notmuch-config')
+        os.environ['NOTSPAM_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        os.environ['NOTSPAM_NATIVE_DB'] = os.path.join(tmp, 'native.db')
+        os.environ['NOTSPAM_SPAMD'] = os.path.join(tmp, 'spamd.sock')
+        os.environ['NOTSPAM_BENCH_LATENCY'] = str(args.latency)
+        os.environ['NOTSPAM_BENCH_MSG_LATENCY'] = str(args.msg_latency)
+        os.environ.pop('NOTSPAM_LOG', None)
+        with open(os.environ['NOTMUCH_CONFIG'], 'w') as f:
+            f.write('[database]\npath=%s\n' % os.environ['MAILDIR'])
+
+        print("generating %d messages..." % args.messages, file=sys.stderr)
+        queries = make_corpus(tmp, args.messages, args.sizes, args.spam_ratio, args.seed)
+        spamd = FakeSpamd(os.environ['NOTSPAM_SPAMD'], latency=args.msg_latency).start()
+
+        results = []
+        try:
+            for name in args.backends.split(','):
+                results += bench_backend(name, queries, args)
+        finally:
+            spamd.shutdown()
+            spamd.server_close()
+
+    report = {
+        'commit': _commit(),
+        'params': {
+            'messages': args.messages,
+            'sizes': args.sizes,
+            'spam_ratio': args.spam_ratio,
+            'seed': args.seed,
+            'latency': args.latency,
+            'msg_latency': args.msg_latency,
+            'batch': args.batch,
+            'jobs': args.jobs,
+            },
+        'results': results,
+        }
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+if __name__ == '__main__':
+    main()
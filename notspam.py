@@ -38,9 +38,14 @@ import os
 import sys
 import time
 import signal
-import notmuch
-import importlib
-import traceback
+import resource
+import contextlib
+import threading
+import collections
+
+# notmuch, and modules only needed by some commands, are imported
+# where they are used, to keep startup fast for e.g. post-new hooks
+# (see 'notspam --startup-bench').
 
 import notspam_classifiers
 from notspam_classifiers import *
@@ -49,13 +54,27 @@ __AUTHOR__ = 'Jameson Rollins <jrollins@finestructure.net>'
 __LICENSE__ = 'GPL v3+'
 __VERSION__ = '0.0'
 _DEFAULT_CLASSIFIER = 'sylfilter'
-CLASSIFIERS = notspam_classifiers.classifiers_list()
+_DEFAULT_BATCH_SIZE = 100
+_STARTUP_BUDGET = 50
+_DEFAULT_ATOMIC_SIZE = 1000
+_DEFAULT_CHECKPOINT = 1000
+_DEFAULT_FOLDS = 5
+_CACHE_MAX_AGE = 30*24*60*60
+_DAEMON_TIMEOUT = 600
+_CACHE_MAX_ENTRIES = 1000000
+
+def __getattr__(name):
+    # CLASSIFIERS is only listed on use, as looking up registered
+    # third-party classifiers is slow
+    if name == 'CLASSIFIERS':
+        return notspam_classifiers.classifiers_list()
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 ############################################################
 
 def _usage():
     clist = '%s (default)' % _DEFAULT_CLASSIFIER
-    for c in CLASSIFIERS:
+    for c in notspam_classifiers.classifiers_list():
         if c in [_DEFAULT_CLASSIFIER, 'null']:
             continue
         clist += ', %s' % c
@@ -69,6 +88,20 @@ Commands:
 
   train [opts] <meat> <search-terms>    train classifier with spam/ham
     --tags=<tag>[,...]                    tags to apply to trained messages
+    --batch=<n>                           messages per trainer call
+                                            (default: %d)
+    --dedup                               train on duplicate messages once
+    --no-journal                          do not skip or record messages
+                                            in the training journal
+    --checkpoint=<n>                      sync classifier and journal every
+                                            n messages (default: %d)
+    --stream                              do not count or sort search
+                                            results first
+    --window=<n>                          search n messages at a time,
+                                            to bound memory use
+    --stats=json                          print run statistics as JSON
+    --via-daemon                          train with a running
+                                            'notspam serve' daemon, if any
     --dry                                 dry run (no training or tagging)
   retrain [opts] <meat> <search-terms>  retrain message (if supported)
                                           see 'train' opts
@@ -76,9 +109,56 @@ Commands:
     --spam=<tag>[,...]                    tags to apply to spam
     --ham=<tag>[,...]                     tags to apply to ham
     --unk=<tag>[,...]                     tags to apply to unknown
+    --batch=<n>                           messages per classifier call
+                                            (default: %d)
+    --jobs=<n>                            number of concurrent classifier
+                                            workers (default: 1)
+    --shards=<n>                          split search into n date ranges,
+                                            each classified by its own
+                                            process (default: 1)
+    --no-cache                            do not use cached results
+    --since-last-run                      only classify messages modified
+                                            since the last run
+    --dedup                               classify duplicate messages once
+    --prefilter                           tag mail from correspondents and
+                                            NOTSPAM_ALLOW/NOTSPAM_DENY
+                                            header matches unclassified
+    --threads[=<policy>]                  classify thread by thread, giving
+                                            the rest of a thread the
+                                            first message's ham verdict
+    --stream                              do not count or sort search
+                                            results first
+    --window=<n>                          search n messages at a time,
+                                            to bound memory use
+    --stats=json                          print run statistics as JSON
+    --via-daemon                          classify with a running
+                                            'notspam serve' daemon, if any
     --dry                                 dry run (no tags applied)
+  sync [opts]                           train and retrain messages whose
+                                          spam/ham labels changed
+    --spam=<search-terms>                 spam messages (default: tag:spam)
+    --ham=<search-terms>                  ham messages (default: tag:ham)
+    --batch=<n>                           messages per trainer call
+    --checkpoint=<n>                      sync classifier and journal every
+                                            n messages
+    --stats=json                          print run statistics as JSON
+    --dry                                 only count the changes
+  evaluate [opts] <spam-search> <ham-search>
+                                        cross-validate classifiers on
+                                          labelled messages
+    --folds=<n>                           number of folds (default: %d)
+    --backends=<classifier>[,...]         classifiers to evaluate
+    --batch=<n>                           messages per classifier call
+    --jobs=<n>                            number of concurrent classifier
+                                            workers (default: 1)
+    --output=<file>                       write JSON report to file
+                                            (default: stdout)
   check <search-terms>                  synonym for 'classify --dry'
+  serve                                 serve train/classify requests
   help                                  this help
+  --startup-bench                       check 'import notspam' time
+                                          is within NOTSPAM_STARTUP_BUDGET
+                                          milliseconds (default: %d)
 
 Description:
 
@@ -89,6 +169,19 @@ Description:
 
     <msg #>/<# msgs> id:<msg-id>
 
+    Trained message-ids are recorded in a journal in
+    NOTSPAM_CACHE_DIR, and the classifier is synced and the journal
+    checkpointed every --checkpoint messages.  Messages already
+    trained as the same meat with the same classifier, by this or an
+    interrupted earlier run, are skipped (but still tagged).  Use
+    --no-journal to train on every message regardless.
+
+  Sync: Compares the messages matching the --spam and --ham searches
+    against the training journal, trains the ones not yet trained,
+    and retrains the ones trained as the other meat.  Only messages
+    modified since the last sync are looked at, so regular syncs
+    only do work for changed labels.
+
   Classify: Messages returned from the specified notmuch search will
     be classified as 'spam', 'ham', or '?' by the classifier.  If
     NOTSPAM_LOG is non-nil, classifications will be logged to stdout:
@@ -97,7 +190,72 @@ Description:
 
     The (<score>) field will be left out if none is returnd by the
     classifier, and the [<applied tags>] field will be left out with
-    --dry.
+    --dry.  With --stream, search results are processed unsorted as
+    notmuch finds them, without counting them first, and the <# msgs>
+    field is replaced by the rate of processing: <msg #> (<rate> msgs/s).
+
+    Classification results are cached per message-id in
+    NOTSPAM_CACHE_DIR (default: ~/.cache/notspam), until the
+    classifier is next trained.  Use --no-cache to classify all
+    messages afresh.
+
+    With --shards, the search is split into date ranges of about
+    equal numbers of messages, each searched and classified by a
+    separate process.  Tags are applied by the main process alone,
+    once all shards are done.
+
+  Duplicates: With --dedup, messages with the same content, ignoring
+    headers added in transit (Received, Delivered-To, etc.), are only
+    trained on or classified once per run.  Duplicates are given the
+    classification of the first copy, and are still tagged.
+
+  Prefilter: With --prefilter, an allowlist of the addresses our sent
+    mail (NOTSPAM_SENT search, default: tag:sent) went to is built at
+    the start of the run.  Messages from those addresses are ham, and
+    are tagged without being classified.  So are messages with a
+    header matching one of the NOTSPAM_ALLOW rules, while those
+    matching a NOTSPAM_DENY rule are spam.  Rules are comma-separated
+    <header>:<substring>, e.g. List-Id:notmuch.notmuchmail.org.  The
+    summary reports the number of prefiltered messages.
+
+  Threads: With --threads, messages are classified thread by thread.
+    The first message of each thread is classified, and if its
+    verdict is confident, the rest of the thread is given the same
+    verdict without being classified.  Threads with our sent mail
+    (NOTSPAM_SENT) in them are ham.  The policy is
+    <meat>[:<low>:<high>]: only 'ham' (default), 'spam' or 'all'
+    verdicts propagate, and not if their score is strictly between
+    <low> and <high>, e.g. --threads=ham:0.1:0.9.  Spam verdicts only
+    propagate with 'spam' or 'all', as a wrong one would tag the
+    legitimate replies in a thread as spam without classifying them.
+    The summary reports the number of messages given their thread's
+    verdict.
+
+  Evaluate: Messages matching <spam-search> but not <ham-search> are
+    taken as spam, and the other way round as ham (quote each search
+    as one argument).  They are split into --folds folds, and each
+    classifier is trained on all folds but one and classified on the
+    remaining one, for each fold in turn, with its training state
+    kept in a temporary directory.  Nothing is tagged.  A JSON report
+    of precision, recall, false positive rate, msgs/s and latency per
+    classifier is written, for comparing configurations over time.
+    By default all classifiers are evaluated, except spamassassin
+    and cascade, whose spamd state can not be kept apart.
+
+  Serve: Run a daemon that keeps the classifier loaded, and serves
+    'train --via-daemon' and 'classify --via-daemon' requests on the
+    unix socket NOTSPAM_SOCKET (default:
+    $XDG_RUNTIME_DIR/notspam.sock).  Without a running daemon, or if
+    it does not answer within NOTSPAM_DAEMON_TIMEOUT seconds (default:
+    600), these do their work in-process as usual.  NOTSPAM_LOG
+    logging is done by the daemon.
+
+  Statistics: With --stats=json, train and classify print a report of
+    message counts, time spent in each phase of the run (database
+    open, query, classification, tagging, etc.), per-message latency
+    and child process CPU and memory use to stdout at the end of the
+    run.  If NOTSPAM_PROFILE is set, the run is profiled with cProfile
+    and the profile written to the file it names.
 
 Classifiers:
 
@@ -105,7 +263,26 @@ Classifiers:
   with the NOTSPAM_CLASSIFIER environment variable):
 
     %s
-""" % clist)
+
+  The spamassassin classifier talks to spamd directly, at the unix
+  socket path or <host>[:<port>] given in NOTSPAM_SPAMD (default:
+  ~/.spamassassin/spamd if it exists, or localhost:783), with at most
+  NOTSPAM_SPAMD_CONNECTIONS (default: 4) concurrent connections.
+
+  Classifiers only see the headers and the first NOTSPAM_MAX_SIZE kB
+  (default: 512, 0 for no limit) of the body of each message, and
+  messages that take longer than NOTSPAM_TIMEOUT seconds (default:
+  60, 0 for no limit) are classified as unknown.  The summary reports
+  the number of truncated and timed out messages.
+
+  The cascade classifier runs a chain of classifiers, cheapest first,
+  only passing messages on to the next when the result is unknown or
+  its score is within the stage's uncertainty band.  The chain is
+  given in NOTSPAM_CASCADE as <classifier>[:<low>:<high>],... (default:
+  bogofilter,spamassassin); the summary reports the number of
+  messages run through each stage.
+""" % (_DEFAULT_BATCH_SIZE, _DEFAULT_CHECKPOINT, _DEFAULT_BATCH_SIZE, _DEFAULT_FOLDS,
+       _STARTUP_BUDGET, clist))
     
 ############################################################
 
@@ -115,7 +292,7 @@ def import_classifier(name):
     Returns a classification system module object.
 
     """
-    return importlib.import_module('.'+name, package='notspam_classifiers')
+    return notspam_classifiers.load_classifier(name)
 
 def _import_classifier(name):
     try:
@@ -127,94 +304,1189 @@ def _import_classifier(name):
     
 ############################################################
 
+def _cache_path(name):
+    """Path to named file in the notspam cache directory.
+
+    The directory is NOTSPAM_CACHE_DIR if set, or
+    $XDG_CACHE_HOME/notspam (~/.cache/notspam) otherwise.
+
+    """
+    cdir = os.getenv('NOTSPAM_CACHE_DIR')
+    if not cdir:
+        cdir = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'notspam')
+    return os.path.join(cdir, name)
+
+def _classifier_name(classifier):
+    return classifier.__name__.split('.')[-1]
+
+def _models(classifier):
+    # names of the classifiers whose models the results of
+    # 'classifier' depend on: itself, and any named by the module's
+    # optional models() (e.g. the cascade's stages)
+    names = [_classifier_name(classifier)]
+    if hasattr(classifier, 'models'):
+        names += [name for name in classifier.models() if name not in names]
+    return names
+
+def _cache_key(cache, classifier):
+    # (name, generation) results of 'classifier' are cached under.
+    # The name is the module's optional cache_name() (e.g. the cascade
+    # with its stage spec), and the generation the sum of the
+    # generations of all its models, so that training any of them
+    # invalidates the results.
+    if hasattr(classifier, 'cache_name'):
+        name = classifier.cache_name()
+    else:
+        name = _classifier_name(classifier)
+    return name, sum(cache.generation(model) for model in _models(classifier))
+
+def _bump_generations(classifier):
+    # the models have changed, so results cached for them are stale
+    with ResultCache() as cache:
+        for name in _models(classifier):
+            cache.bump_generation(name)
+
+class ResultCache(object):
+    """On-disk cache of classification results.
+
+    Maps message-id, classifier name and model generation to the
+    (isspam, score) classification result.  The model generation of a
+    classifier is bumped every time the classifier is trained (see
+    bump_generation()), which invalidates all results cached for it.
+
+    Entries older than 'max_age' seconds are evicted, as are the
+    oldest entries beyond 'max_entries', when the cache is closed.
+
+    """
+    def __init__(self, path=None, max_age=_CACHE_MAX_AGE, max_entries=_CACHE_MAX_ENTRIES):
+        if path is None:
+            path = _cache_path('results.sqlite')
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS generations ('
+                            ' classifier TEXT PRIMARY KEY,'
+                            ' generation INTEGER NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                            ' msgid TEXT NOT NULL,'
+                            ' classifier TEXT NOT NULL,'
+                            ' generation INTEGER NOT NULL,'
+                            ' isspam INTEGER,'
+                            ' score TEXT,'
+                            ' time REAL NOT NULL,'
+                            ' PRIMARY KEY (msgid, classifier, generation))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_time ON results (time)')
+
+    def generation(self, classifier):
+        """Current model generation of named classifier."""
+        row = self.db.execute('SELECT generation FROM generations WHERE classifier = ?',
+                              (classifier,)).fetchone()
+        if row:
+            return row[0]
+        return 0
+
+    def bump_generation(self, classifier):
+        """Bump model generation of named classifier.
+
+        Should be called whenever the classifier model changes.
+        Results cached for previous generations are dropped.
+
+        """
+        generation = self.generation(classifier) + 1
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO generations VALUES (?, ?)',
+                            (classifier, generation))
+            self.db.execute('DELETE FROM results WHERE classifier = ? AND generation < ?',
+                            (classifier, generation))
+        return generation
+
+    def get(self, msgid, classifier, generation):
+        """Cached (isspam, score) for message, or None if not cached."""
+        row = self.db.execute('SELECT isspam, score FROM results'
+                              ' WHERE msgid = ? AND classifier = ? AND generation = ?',
+                              (msgid, classifier, generation)).fetchone()
+        if row is None:
+            return None
+        isspam, score = row
+        if isspam is not None:
+            isspam = bool(isspam)
+        return isspam, score
+
+    def put(self, classifier, generation, results):
+        """Cache (msgid, isspam, score) results, e.g. of a batch.
+
+        The results are committed at once, so that the cache is not
+        kept locked against other writers between batches.
+
+        """
+        now = time.time()
+        rows = []
+        for msgid, isspam, score in results:
+            if isspam is not None:
+                isspam = int(isspam)
+            if score is not None:
+                score = str(score)
+            rows.append((msgid, classifier, generation, isspam, score, now))
+        if not rows:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def evict(self):
+        """Evict entries that are too old or beyond the size limit."""
+        with self.db:
+            if self.max_age is not None:
+                self.db.execute('DELETE FROM results WHERE time < ?',
+                                (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self.db.execute('DELETE FROM results WHERE rowid IN'
+                                ' (SELECT rowid FROM results ORDER BY time DESC LIMIT -1 OFFSET ?)',
+                                (self.max_entries,))
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RunState(object):
+    """Record of the database revision seen by previous classify runs.
+
+    Stores the notmuch database UUID and lastmod revision at the end
+    of the last successful run, per query string and classifier, so
+    that later runs can be restricted to messages modified since.
+
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = _cache_path('state.sqlite')
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                            ' query TEXT NOT NULL,'
+                            ' classifier TEXT NOT NULL,'
+                            ' uuid TEXT NOT NULL,'
+                            ' lastmod INTEGER NOT NULL,'
+                            ' PRIMARY KEY (query, classifier))')
+
+    def get(self, query_string, classifier):
+        """(uuid, lastmod) of last run, or None if never run."""
+        return self.db.execute('SELECT uuid, lastmod FROM runs WHERE query = ? AND classifier = ?',
+                               (query_string, classifier)).fetchone()
+
+    def put(self, query_string, classifier, uuid, lastmod):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                            (query_string, classifier, uuid, lastmod))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TrainJournal(object):
+    """Journal of messages trained, per classifier.
+
+    Records the meat each message-id was last trained as.  Entries
+    added with add() are only committed by checkpoint(), which should
+    be called right after the trainer has been synced, so that the
+    journal never records training that was lost.  An interrupted
+    run thus loses at most the entries since the last checkpoint,
+    whose messages are trained again by the next run.
+
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = _cache_path('journal.sqlite')
+        import sqlite3
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS trained ('
+                            ' msgid TEXT NOT NULL,'
+                            ' classifier TEXT NOT NULL,'
+                            ' meat TEXT NOT NULL,'
+                            ' time INTEGER NOT NULL,'
+                            ' PRIMARY KEY (msgid, classifier))')
+
+    def trained(self, msgids, classifier, meat):
+        """Set of those message-ids already trained as meat."""
+        found = set()
+        msgids = list(msgids)
+        # stay within SQLite's limit on the number of parameters
+        for i in range(0, len(msgids), 500):
+            chunk = msgids[i:i+500]
+            found.update(row[0] for row in self.db.execute(
+                'SELECT msgid FROM trained WHERE classifier = ? AND meat = ? AND msgid IN (%s)'
+                % ','.join('?' * len(chunk)), [classifier, meat] + chunk))
+        return found
+
+    def add(self, msgid, classifier, meat):
+        self.db.execute('INSERT OR REPLACE INTO trained VALUES (?, ?, ?, ?)',
+                        (msgid, classifier, meat, int(time.time())))
+
+    def checkpoint(self):
+        self.db.commit()
+
+    def close(self):
+        # uncommitted entries are rolled back
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+############################################################
+
+# headers added or rewritten in transit, which differ between
+# otherwise identical copies of a message
+_TRANSPORT_HEADERS = set([
+    b'received',
+    b'return-path',
+    b'delivered-to',
+    b'envelope-to',
+    b'x-original-to',
+    b'x-received',
+    b'received-spf',
+    b'authentication-results',
+    b'arc-seal',
+    b'arc-message-signature',
+    b'arc-authentication-results',
+    ])
+
+def content_digest(path):
+    """Digest of message file content, ignoring transport headers.
+
+    Copies of a message delivered along different paths have the same
+    digest.  Transport headers are those in _TRANSPORT_HEADERS, and
+    any X-Spam-* or X-CRM114-* headers added by spam filters.  CRLF
+    line endings are taken as LF, so that copies stored either way
+    match.
+
+    """
+    import hashlib
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        skip = False
+        for line in f:
+            line = line.rstrip(b'\r\n') + b'\n'
+            if line == b'\n':
+                break
+            if line[:1] not in b' \t':
+                name = line.split(b':', 1)[0].strip().lower()
+                skip = (name in _TRANSPORT_HEADERS
+                        or name.startswith(b'x-spam-')
+                        or name.startswith(b'x-crm114-'))
+            if not skip:
+                digest.update(line)
+        digest.update(b'\n')
+        # a CR at the end of a chunk may start a CRLF
+        cr = b''
+        for data in iter(lambda: f.read(65536), b''):
+            data = cr + data
+            cr = b''
+            if data.endswith(b'\r'):
+                data, cr = data[:-1], b'\r'
+            digest.update(data.replace(b'\r\n', b'\n'))
+        digest.update(cr)
+    return digest.digest()
+
+def _digest(msg):
+    try:
+        return content_digest(msg.get_filename())
+    except OSError:
+        return None
+
 def _logproc(msg, end='\n'):
     if not os.getenv('NOTSPAM_LOG'):
         return
     output = sys.stdout
     print(msg, end=end, file=output)
 
-def _tag_msg(msg, tags):
-    if not tags:
-        return
-    msg.freeze()
-    for tag in tags:
-        if tag[0] == '+':
-            msg.add_tag(tag[1:])
-        elif tag[0] == '-':
-            msg.remove_tag(tag[1:])
+class _Progress(object):
+    # progress for log lines: '<n>/<total>', or '<n> (<rate> msgs/s)'
+    # when the total is not known
+    def __init__(self, total=None):
+        self.total = total
+        self.start = time.perf_counter()
+
+    def __call__(self, n):
+        if self.total is not None:
+            return '%d/%d' % (n, self.total)
+        elapsed = time.perf_counter() - self.start
+        return '%d (%.1f msgs/s)' % (n, n/elapsed if elapsed else 0.0)
+
+def _search(db, query_string, stats, stream=False, window=None):
+    """Messages in search, and the number of messages it matches.
+
+    Returns the tuple (msgs, nmsgs), where 'msgs' is an iterator of
+    the messages.  If 'stream' is True, the results are left unsorted
+    and are not counted beforehand ('nmsgs' is None), so that notmuch
+    only has to match the search once, and the first results are
+    available as soon as they are found.  If 'window' is given, the
+    messages are iterated in windows of about that many (see
+    _windowed()).
+
+    """
+    import notmuch
+    query = db.create_query(query_string)
+    nmsgs = None
+    if not stream:
+        with stats.phase('count'):
+            nmsgs = query.count_messages()
+    if window:
+        del query
+        return _windowed(db, query_string, window), nmsgs
+    if stream:
+        query.set_sort(notmuch.Query.SORT.UNSORTED)
+    return query.search_messages(), nmsgs
+
+def _windowed(db, query_string, window):
+    """Iterate over messages in search, with a new query per window.
+
+    notmuch keeps every message returned by a query until the query
+    is destroyed, so iterating over a large search with a single
+    query takes memory in proportion to its size.  Instead, messages
+    are taken oldest first, and after 'window' messages the query is
+    dropped and a new one made for the messages from the date of the
+    last one on.  Memory use is then bounded by the window size (and
+    any messages the caller holds on to).
+
+    Windows only end between messages with different dates (to the
+    second), so a window may run over for messages with the same
+    date.
+
+    """
+    import notmuch
+    start = None
+    # ids of messages already seen with the 'start' date
+    seen = set()
+    while True:
+        if start is None:
+            search_string = query_string
         else:
+            search_string = '(%s) and (date:@%d..)' % (query_string, start)
+        query = db.create_query(search_string)
+        query.set_sort(notmuch.Query.SORT.OLDEST_FIRST)
+        n = 0
+        last = start
+        lastseen = set(seen)
+        for msg in query.search_messages():
+            date = msg.get_date()
+            msgid = msg.get_message_id()
+            if date == start and msgid in seen:
+                continue
+            if date != last:
+                if n >= window:
+                    break
+                last = date
+                lastseen = set()
+            lastseen.add(msgid)
+            n += 1
+            yield msg
+        else:
+            return
+        del msg, query
+        start = last
+        seen = lastseen
+
+def _batches(msgs, size):
+    batch = []
+    for msg in msgs:
+        batch.append(msg)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Tagger(object):
+    """Apply tag changes to messages in a database.
+
+    The requested tag changes are first diffed against the current
+    tags of each message, and messages that would not change are not
+    touched at all.  Actual changes are grouped in atomic sections of
+    up to 'atomic_size' messages.  Call flush() (or use as a context
+    manager) to close the final atomic section.
+
+    'nchanged' is the number of messages whose tags were changed.
+
+    """
+    def __init__(self, db, atomic_size=_DEFAULT_ATOMIC_SIZE):
+        self.db = db
+        self.atomic_size = atomic_size
+        self.nchanged = 0
+        self.__natomic = 0
+
+    @staticmethod
+    def diff(msg, tags):
+        """Return (add, remove) sets of tags that would change msg.
+
+        'tags' is a list of tags, each optionally prefixed with '+'
+        (add, the default) or '-' (remove), applied in order.
+
+        """
+        current = set(msg.get_tags())
+        new = set(current)
+        for tag in tags:
+            if tag[0] == '+':
+                new.add(tag[1:])
+            elif tag[0] == '-':
+                new.discard(tag[1:])
+            else:
+                new.add(tag)
+        return new - current, current - new
+
+    def tag(self, msg, tags):
+        """Apply tags to message.
+
+        Returns True if the message tags were changed.
+
+        """
+        if not tags:
+            return False
+        add, remove = self.diff(msg, tags)
+        if not add and not remove:
+            return False
+        if self.__natomic == 0:
+            self.db.begin_atomic()
+        msg.freeze()
+        for tag in remove:
+            msg.remove_tag(tag)
+        for tag in add:
             msg.add_tag(tag)
-    msg.thaw()
+        msg.thaw()
+        self.nchanged += 1
+        self.__natomic += 1
+        if self.__natomic >= self.atomic_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Close any open atomic section."""
+        if self.__natomic:
+            self.db.end_atomic()
+            self.__natomic = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
 
 ############################################################
 
-def train(classifier, meat, query_string, tags=[], retrain=False, dry=True):
+class Histogram(object):
+    """Log-scale histogram of latencies in seconds.
+
+    Bucket n counts latencies of less than 2**n microseconds (and at
+    least 2**(n-1)).
+
+    """
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, n=1):
+        """Add 'n' samples of the given latency."""
+        self.buckets[int(seconds * 1e6).bit_length()] += n
+        self.count += n
+        self.total += seconds * n
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Add samples of other Histogram."""
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper bound of latency at quantile 'q' (0 to 1)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(2**bucket / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets_us': {str(2**b): n for b, n in sorted(self.buckets.items())},
+            }
+
+class Stats(object):
+    """Statistics of a train() or classify() run.
+
+    'counts' is a Counter of messages by outcome (see train() and
+    classify() for the keys used), 'phases' the wall clock seconds
+    spent in each phase of the run, and 'latency' a Histogram of
+    per-message classifier latency.  'elapsed' is the total wall clock
+    time of the run, 'child_cpu' the CPU seconds used by child
+    processes (e.g. external classifiers) during the run, and
+    'child_maxrss' the largest child resident set size, in kB.
+
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.phases = collections.defaultdict(float)
+        self.latency = Histogram()
+        self.elapsed = 0.0
+        self.child_cpu = 0.0
+        self.child_maxrss = 0
+        self.__start = time.perf_counter()
+        self.__rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager adding time spent in block to named phase."""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - t
+
+    def timed(self, name, iterable):
+        """Iterate, adding time spent producing each item to named phase."""
+        iterator = iter(iterable)
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.phases[name] += time.perf_counter() - t
+            yield item
+
+    def finish(self):
+        """Record total elapsed time and child resource usage."""
+        self.elapsed = time.perf_counter() - self.__start
+        rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.child_cpu = (rusage.ru_utime - self.__rusage.ru_utime
+                          + rusage.ru_stime - self.__rusage.ru_stime)
+        self.child_maxrss = rusage.ru_maxrss
+        return self
+
+    def merge(self, other):
+        """Add counts, phase times and latencies of other Stats."""
+        self.counts.update(other.counts)
+        for name, seconds in other.phases.items():
+            self.phases[name] += seconds
+        self.latency.merge(other.latency)
+
+    @classmethod
+    def from_dict(cls, d):
+        """Stats from dict created by as_dict()."""
+        stats = cls()
+        stats.elapsed = d['elapsed']
+        stats.counts.update(d['counts'])
+        stats.phases.update(d['phases'])
+        for bound, n in d['latency']['buckets_us'].items():
+            stats.latency.buckets[int(bound).bit_length() - 1] += n
+        stats.latency.count = d['latency']['count']
+        stats.latency.total = (d['latency']['mean'] or 0) * stats.latency.count
+        stats.latency.max = d['latency']['max']
+        stats.child_cpu = d['child_cpu']
+        stats.child_maxrss = d['child_maxrss_kb']
+        return stats
+
+    def as_dict(self):
+        return {
+            'elapsed': self.elapsed,
+            'counts': dict(self.counts),
+            'phases': dict(self.phases),
+            'latency': self.latency.as_dict(),
+            'child_cpu': self.child_cpu,
+            'child_maxrss_kb': self.child_maxrss,
+            }
+
+def _stats_format(fmt):
+    if fmt not in ['json']:
+        sys.exit("Unknown stats format '%s'." % fmt)
+    return fmt
+
+def _print_stats(stats, fmt):
+    if fmt == 'json':
+        import json
+        print(json.dumps(stats.as_dict(), indent=2, sort_keys=True))
+
+def _profile(func, *args, **kwargs):
+    """Call function, profiled to file NOTSPAM_PROFILE if set."""
+    path = os.getenv('NOTSPAM_PROFILE')
+    if not path:
+        return func(*args, **kwargs)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(path)
+        print("profile written to %s" % path, file=sys.stderr)
+
+############################################################
+
+def _train_batch(trainer, msgs):
+    """Add a list of messages with trainer's batch interface.
+
+    If the batch as a whole fails, fall back to adding the messages
+    individually, so that errors can be attributed to specific
+    messages.  Returns a list with None for each message trained, or
+    a NotspamTrainingError for messages that failed.
+
+    """
+    try:
+        trainer.add_batch(msgs)
+        return [None] * len(msgs)
+    except NotspamTrainingError as e:
+        if len(msgs) == 1:
+            return [e]
+    results = []
+    for msg in msgs:
+        try:
+            trainer.add(msg)
+            results.append(None)
+        except NotspamTrainingError as e:
+            results.append(e)
+    return results
+
+def train(classifier, meat, query_string, tags=[], retrain=False, dry=True,
+          atomic_size=_DEFAULT_ATOMIC_SIZE, batch_size=_DEFAULT_BATCH_SIZE, dedup=False,
+          stream=False, window=None, journal=True, checkpoint=_DEFAULT_CHECKPOINT):
     """Train classifier with specified messages as ham or spam.
 
     'classifier' is classifier module imported with
     import_classifier().  'query_string' is a notmuch query string.
     'tags' is a list of tags to be applied to all messages used in
-    training.  If 'dry' is False, messages will not be tagged.
-
-    Returns the number of messages trained on.
+    training.  If 'dry' is False, messages will not be tagged.  Tag
+    changes are committed in atomic sections of up to 'atomic_size'
+    messages.  Messages are handed to the trainer in batches of up to
+    'batch_size' messages.  If 'dedup' is True, messages with the same
+    content as one already trained on in this run (see
+    content_digest()) are not trained on again, but are still tagged.
+    If 'stream' is True, the search is neither counted nor sorted
+    first (see _search()).  If 'window' is given, the search is
+    iterated that many messages at a time, to bound memory use (see
+    _windowed()).
+
+    If 'journal' is True, messages are recorded in the default
+    TrainJournal as they are trained, and messages the journal shows
+    as already trained with this classifier and meat (e.g. by an
+    interrupted run) are skipped, though still tagged.  A TrainJournal
+    object may also be passed.  The trainer is synced and the journal
+    checkpointed every 'checkpoint' messages trained.
+
+    Returns a Stats object, with counts:
+      msgs        number of messages in search
+      trained     number of messages trained on
+      journaled   number of messages skipped as already trained
+      duplicates  number of duplicate messages not trained on
+      errors      number of messages that failed training
+      changed     number of messages whose tags were changed
 
     """
+    if journal is True:
+        with TrainJournal() as journal:
+            return train(classifier, meat, query_string, tags=tags, retrain=retrain, dry=dry,
+                         atomic_size=atomic_size, batch_size=batch_size, dedup=dedup,
+                         stream=stream, window=window, journal=journal,
+                         checkpoint=checkpoint)
+
+    import notmuch
+    stats = Stats()
     trainer = classifier.Trainer(meat, retrain=retrain)
+    cname = _classifier_name(classifier)
+    ntrained = 0
+
+    def sync():
+        nonlocal trainer
+        # syncing ends a trainer (e.g. closes the stdin of its training
+        # process), so a new one is started for any further messages
+        if trainer is not None:
+            trainer.sync()
+            trainer = None
+        if journal:
+            journal.checkpoint()
+        _bump_generations(classifier)
 
     # open the database READ.WRITE, as this seems to be the only way
     # to lock the database, which we want during this potentially long
-    # operation.
-    with notmuch.Database(mode=1, path=os.environ.get('MAILDIR', None)) as db:
-        query = db.create_query(query_string)
-        nmsgs = query.count_messages()
+    # operation.  A dry run does not tag, so it does not take the lock
+    # (e.g. from 'notmuch new').
+    with stats.phase('open'):
+        db = notmuch.Database(mode=0 if dry else 1, path=os.environ.get('MAILDIR', None))
+    with db, Tagger(db, atomic_size=atomic_size) as tagger:
+        msgs, nmsgs = _search(db, query_string, stats, stream=stream, window=window)
+        progress = _Progress(nmsgs)
         nmsg = 0
-        for msg in query.search_messages():
-            nmsg += 1
-
-            logmsg = '%d/%d' % (nmsg, nmsgs)
-            _logproc(logmsg+' id:%s' % (msg.get_message_id()), end='\r')
-
+        digests = set()
+        for batch in _batches(stats.timed('query', msgs), batch_size):
+            _logproc('%s id:%s' % (progress(nmsg+len(batch)), batch[-1].get_message_id()), end='\r')
+
+            # messages not to train on: 'DUP' duplicates, and
+            # 'TRAINED' messages already in the journal
+            skip = [None] * len(batch)
+            if journal:
+                with stats.phase('journal'):
+                    trained = journal.trained([msg.get_message_id() for msg in batch],
+                                              cname, meat)
+                for i, msg in enumerate(batch):
+                    if msg.get_message_id() in trained:
+                        skip[i] = 'TRAINED'
+            if dedup:
+                with stats.phase('dedup'):
+                    for i, msg in enumerate(batch):
+                        if skip[i]:
+                            continue
+                        digest = _digest(msg)
+                        if digest in digests:
+                            skip[i] = 'DUP'
+                        elif digest is not None:
+                            digests.add(digest)
+            distinct = [msg for msg, why in zip(batch, skip) if not why]
+
+            if distinct and trainer is None:
+                trainer = classifier.Trainer(meat, retrain=retrain)
+            t = time.perf_counter()
             try:
-                cmsg = trainer.add(msg)
-            except NotspamTrainingError as e:
-                print("Training error: id:%s" % (msg.get_message_id()), file=sys.stderr)
-                print("  %s" % e, file=sys.stderr)
-                continue
+                results = _train_batch(trainer, distinct) if distinct else []
             except:
-                print("Fatal error: id:%s" % (msg.get_message_id()), file=sys.stderr)
+                print("Fatal error: id:%s" % (distinct[0].get_message_id()), file=sys.stderr)
                 raise
-
-            if cmsg:
-                logmsg += ' %s'
-            if not dry:
-                logmsg += ' %s' % (tags)
-                _tag_msg(msg, tags)
-            logmsg += ' id:%s     ' % (msg.get_message_id())
-            _logproc(logmsg)
-
-    trainer.sync()
-
-    return nmsgs
-
-def _train(*args, **kwargs):
-    t = time.time()
-    nmsgs = train(*args, **kwargs)
-    t = time.time() - t
-    if kwargs['retrain']:
+            finally:
+                t = time.perf_counter() - t
+                stats.phases['train'] += t
+                if distinct:
+                    stats.latency.add(t/len(distinct), len(distinct))
+
+            results = iter(results)
+            for msg, why in zip(batch, skip):
+                nmsg += 1
+
+                logmsg = progress(nmsg)
+                if why:
+                    logmsg += ' %s' % why
+                    stats.counts['duplicates' if why == 'DUP' else 'journaled'] += 1
+                else:
+                    error = next(results)
+                    if error is not None:
+                        print("Training error: id:%s" % (msg.get_message_id()), file=sys.stderr)
+                        print("  %s" % error, file=sys.stderr)
+                        stats.counts['errors'] += 1
+                        continue
+                    stats.counts['trained'] += 1
+                    if journal:
+                        journal.add(msg.get_message_id(), cname, meat)
+
+                if not dry:
+                    logmsg += ' %s' % (tags)
+                    with stats.phase('tag'):
+                        tagger.tag(msg, tags)
+                logmsg += ' id:%s     ' % (msg.get_message_id())
+                _logproc(logmsg)
+
+            if checkpoint and stats.counts['trained'] - ntrained >= checkpoint:
+                with stats.phase('sync'):
+                    sync()
+                ntrained = stats.counts['trained']
+
+    with stats.phase('sync'):
+        sync()
+
+    stats.counts['msgs'] = nmsg
+    stats.counts['changed'] = tagger.nchanged
+    return stats.finish()
+
+def _train_summary(stats, meat, retrain):
+    nmsgs = stats.counts['trained']
+    if retrain:
         act = 'retrained'
     else:
         act = 'trained'
-    print("%s %d '%s' messages in %.2fs (%.2f msgs/s)" % (
+    summary = "%s %d '%s' messages in %.2fs (%.2f msgs/s), %d tagged" % (
         act,
         nmsgs,
-        args[1],
-        t,
-        nmsgs/t),
-          file=sys.stderr)
+        meat,
+        stats.elapsed,
+        nmsgs/stats.elapsed,
+        stats.counts['changed'])
+    if stats.counts['duplicates']:
+        summary += ', %d duplicates' % stats.counts['duplicates']
+    if stats.counts['journaled']:
+        summary += ', %d already trained' % stats.counts['journaled']
+    print(summary, file=sys.stderr)
+
+def _train(*args, **kwargs):
+    stats = _profile(train, *args, **kwargs)
+    _train_summary(stats, args[1], kwargs['retrain'])
+    return stats
+
+def sync(classifier, spam_query='tag:spam', ham_query='tag:ham', dry=True,
+         batch_size=_DEFAULT_BATCH_SIZE, checkpoint=_DEFAULT_CHECKPOINT):
+    """Bring training in line with current spam and ham labels.
+
+    'spam_query' and 'ham_query' are notmuch query strings for the
+    messages labelled spam and ham (messages matching both are left
+    alone).  Each is compared against the TrainJournal: messages not
+    yet trained are trained as their label, messages trained as the
+    other meat are retrained, and messages already trained as their
+    label are left alone.  If 'dry' is True, the differences are only
+    counted.
+
+    Only messages modified since the last complete sync (per
+    classifier) are looked at, so the work done is proportional to
+    the changes since then rather than to the size of the corpus.  The
+    trainers are synced and the journal checkpointed every
+    'checkpoint' messages trained.
+
+    Returns a Stats object, with counts:
+      msgs        number of labelled messages looked at
+      trained     number of messages trained on
+      retrained   number of messages retrained as the other meat
+      unchanged   number of messages already trained as labelled
+      errors      number of messages that failed training
+
+    """
+    import notmuch
+    stats = Stats()
+    cname = _classifier_name(classifier)
+    key = 'sync:(%s):(%s)' % (spam_query, ham_query)
+    searches = {
+        'spam': '(%s) and not (%s)' % (spam_query, ham_query),
+        'ham': '(%s) and not (%s)' % (ham_query, spam_query),
+        }
+
+    # labelled messages to train, as {(meat, retrain): [msgs]}
+    todo = collections.defaultdict(list)
+    with stats.phase('open'):
+        db = notmuch.Database(mode=0, path=os.environ.get('MAILDIR', None))
+    with db, TrainJournal() as journal:
+        revision, uuid = db.get_revision()
+        for meat, query_string in sorted(searches.items()):
+            other = 'ham' if meat == 'spam' else 'spam'
+            search_string = _since_last_run(query_string, cname, uuid, revision, key=key)
+            msgs, nmsgs = _search(db, search_string, stats, stream=True)
+            for batch in _batches(stats.timed('query', msgs), batch_size):
+                stats.counts['msgs'] += len(batch)
+                msgids = [msg.get_message_id() for msg in batch]
+                with stats.phase('journal'):
+                    trained = journal.trained(msgids, cname, meat)
+                    flipped = journal.trained(msgids, cname, other)
+                for msg in batch:
+                    msgid = msg.get_message_id()
+                    if msgid in trained:
+                        stats.counts['unchanged'] += 1
+                    else:
+                        todo[(meat, msgid in flipped)].append(_MessageRef(msg))
+
+        if dry:
+            for (meat, retrain), refs in todo.items():
+                stats.counts['retrained' if retrain else 'trained'] += len(refs)
+            return stats.finish()
+
+        ntrained = 0
+        for (meat, retrain), refs in sorted(todo.items()):
+            trainer = classifier.Trainer(meat, retrain=retrain)
+            count = 'retrained' if retrain else 'trained'
+            for batch in _batches(refs, batch_size):
+                if trainer is None:
+                    trainer = classifier.Trainer(meat, retrain=retrain)
+                t = time.perf_counter()
+                results = _train_batch(trainer, batch)
+                t = time.perf_counter() - t
+                stats.phases['train'] += t
+                stats.latency.add(t/len(batch), len(batch))
+                for ref, error in zip(batch, results):
+                    if error is not None:
+                        print("Training error: id:%s" % (ref.get_message_id()), file=sys.stderr)
+                        print("  %s" % error, file=sys.stderr)
+                        stats.counts['errors'] += 1
+                        continue
+                    stats.counts[count] += 1
+                    journal.add(ref.get_message_id(), cname, meat)
+                    _logproc('%s %s id:%s' % (count, meat, ref.get_message_id()))
+                ntrained += len(batch)
+                if checkpoint and ntrained >= checkpoint:
+                    # a synced trainer is done, so start a new one for
+                    # the rest
+                    with stats.phase('sync'):
+                        trainer.sync()
+                        journal.checkpoint()
+                    trainer = None
+                    ntrained = 0
+            if trainer is not None:
+                with stats.phase('sync'):
+                    trainer.sync()
+                    journal.checkpoint()
+
+    if todo:
+        _bump_generations(classifier)
+
+    # messages that failed will be looked at again next time only if
+    # this sync is not recorded
+    if not stats.counts['errors']:
+        with RunState() as state:
+            state.put(key, cname, uuid, revision)
+
+    return stats.finish()
+
+def _sync_summary(stats):
+    summary = 'synced %d messages in %.2fs: %d trained, %d retrained, %d unchanged' % (
+        stats.counts['msgs'],
+        stats.elapsed,
+        stats.counts['trained'],
+        stats.counts['retrained'],
+        stats.counts['unchanged'])
+    if stats.counts['errors']:
+        summary += ', %d errors' % stats.counts['errors']
+    print(summary, file=sys.stderr)
+
+def _sync(*args, **kwargs):
+    stats = _profile(sync, *args, **kwargs)
+    _sync_summary(stats)
+    return stats
 
 ############################################################
 
-def classify(classifier, query_string, spam_tags=[], ham_tags=[], unk_tags=[], dry=True):
+def _apply_tags(changes, revision, atomic_size=_DEFAULT_ATOMIC_SIZE):
+    """Apply tag changes collected by a read-only scan.
+
+    'changes' is a list of (msg-id, tags) tuples, and 'revision' the
+    database revision at the start of the scan.  The database is
+    opened READ_WRITE only for the duration of this call.  Messages
+    modified since 'revision' are skipped, as their tags may have
+    been changed under us.
+
+    Returns the tuple (nchanged, nskipped, modified, revision, uuid).
+    'modified' is True if any message at all (not only those to be
+    tagged, e.g. new mail) was modified since 'revision', and the last
+    two are the database revision after the changes.
+
+    """
+    import notmuch
+    with notmuch.Database(mode=1, path=os.environ.get('MAILDIR', None)) as db:
+        query = db.create_query('lastmod:%d..' % (revision+1))
+        modified = set(msg.get_message_id() for msg in query.search_messages())
+        del query
+        nskipped = 0
+        with Tagger(db, atomic_size=atomic_size) as tagger:
+            for msgid, tags in changes:
+                msg = None
+                if msgid not in modified:
+                    msg = db.find_message(msgid)
+                if msg is None:
+                    nskipped += 1
+                    continue
+                tagger.tag(msg, tags)
+        revision, uuid = db.get_revision()
+    return tagger.nchanged, nskipped, bool(modified), revision, uuid
+
+class _MessageRef(object):
+    """Message stand-in handed to classifier worker threads.
+
+    Carries only the message-id and file path of a notmuch message,
+    so that notmuch objects never leave the main thread.
+
+    """
+    def __init__(self, msg):
+        self._id = msg.get_message_id()
+        self._filename = msg.get_filename()
+
+    def get_message_id(self):
+        return self._id
+
+    def get_filename(self):
+        return self._filename
+
+def _header_rules(spec):
+    # list of (header, lowercased substring) rules from comma-separated
+    # '<header>:<substring>' spec
+    rules = []
+    for rule in spec.split(','):
+        if not rule.strip():
+            continue
+        header, sep, value = rule.partition(':')
+        if not sep or not header.strip() or not value.strip():
+            raise ValueError("bad header rule '%s'" % rule)
+        rules.append((header.strip(), value.strip().lower()))
+    return rules
+
+class Prefilter(object):
+    """Allowlist/denylist decided before classification.
+
+    Built once per run from the database: the allowlist holds the
+    addresses our sent mail (NOTSPAM_SENT search, default: tag:sent)
+    was addressed to (To/Cc), less our own (From) addresses.  Header
+    rules are read from NOTSPAM_ALLOW and NOTSPAM_DENY, as
+    comma-separated '<header>:<substring>' rules matched
+    case-insensitively against the message header, e.g.
+
+      NOTSPAM_ALLOW='List-Id:notmuch.notmuchmail.org'
+
+    Deny rules are checked first, then allow rules, then the sender
+    against the allowlist.  Headers are read with msg.get_header(),
+    so the message file itself is not classified.  The object only
+    holds plain sets and lists, so can be handed to shard workers.
+
+    """
+    def __init__(self, db, sent_query=None, allow=None, deny=None):
+        import email.utils
+        if sent_query is None:
+            sent_query = os.getenv('NOTSPAM_SENT', 'tag:sent')
+        self.allow = _header_rules(os.getenv('NOTSPAM_ALLOW', '') if allow is None else allow)
+        self.deny = _header_rules(os.getenv('NOTSPAM_DENY', '') if deny is None else deny)
+        self.addresses = set()
+        ours = set()
+        query = db.create_query(sent_query)
+        for msg in query.search_messages():
+            for name, addr in email.utils.getaddresses([msg.get_header('From')]):
+                ours.add(addr.lower())
+            headers = [msg.get_header('To'), msg.get_header('Cc')]
+            for name, addr in email.utils.getaddresses([h for h in headers if h]):
+                if '@' in addr:
+                    self.addresses.add(addr.lower())
+        self.addresses -= ours
+
+    def __len__(self):
+        return len(self.addresses) + len(self.allow) + len(self.deny)
+
+    def check(self, msg):
+        """(isspam, reason) for message, or None if undecided."""
+        import email.utils
+        for isspam, rules in [(True, self.deny), (False, self.allow)]:
+            for header, value in rules:
+                if value in (msg.get_header(header) or '').lower():
+                    return isspam, '%s:%s' % ('deny' if isspam else 'allow', header)
+        if self.addresses:
+            name, addr = email.utils.parseaddr(msg.get_header('From') or '')
+            if addr.lower() in self.addresses:
+                return False, 'allow:correspondent'
+        return None
+
+class ThreadPolicy(object):
+    """Thread-level verdicts for thread-aware classification.
+
+    The policy spec is '<meat>[:<low>:<high>]', where <meat> is the
+    verdicts that propagate to the rest of a thread ('ham', the
+    default, 'spam' or 'all'), and scores strictly between <low> and
+    <high> are not confident enough to propagate (as for cascade
+    stages, see notspam_classifiers.uncertain()).  Threads holding
+    any of our sent mail (NOTSPAM_SENT search, default: tag:sent) are
+    ham from the start.  The verdicts themselves are kept in
+    'verdicts', by thread id, as the run goes.
+
+    """
+    def __init__(self, db, spec='ham', sent_query=None):
+        meat, *band = spec.split(':')
+        if meat not in ['ham', 'spam', 'all'] or len(band) not in [0, 2]:
+            raise ValueError("bad thread policy '%s'" % spec)
+        self.propagate = {'ham': [False], 'spam': [True], 'all': [False, True]}[meat]
+        self.band = (float(band[0]), float(band[1])) if band else None
+        if sent_query is None:
+            sent_query = os.getenv('NOTSPAM_SENT', 'tag:sent')
+        query = db.create_query(sent_query)
+        self.verdicts = {msg.get_thread_id(): (False, 'thread:sent')
+                         for msg in query.search_messages()}
+        # threads whose representative message is being classified,
+        # and threads it left undecided
+        self.pending = set()
+        self.undecided = set()
+
+    def decide(self, tid, result):
+        """Record result as verdict for thread if confident.
+
+        Returns True if the thread has a verdict.
+
+        """
+        if tid in self.verdicts:
+            return True
+        if not isinstance(result, tuple):
+            return False
+        isspam, score = result
+        if isspam not in self.propagate:
+            return False
+        # compare e.g. cascade 'bogofilter:0.99' scores by the score
+        if uncertain((isspam, str(score).rpartition(':')[2]), self.band):
+            return False
+        self.verdicts[tid] = (isspam, 'thread:%s' % score if score else 'thread')
+        return True
+
+def _thread_messages(db, query_string, stats):
+    """Messages in search, grouped by thread.
+
+    Returns the tuple (msgs, nmsgs) as _search() does.  Threads are
+    taken in search order, and the messages of each thread that match
+    the search in thread order.
+
+    """
+    import notmuch
+    query = db.create_query(query_string)
+    with stats.phase('count'):
+        nmsgs = query.count_messages()
+
+    def msgs():
+        for thread in query.search_threads():
+            for msg in thread.get_messages():
+                if msg.get_flag(notmuch.Message.FLAG.MATCH):
+                    yield msg
+
+    return msgs(), nmsgs
+
+def _classify_batch(classify, msgs):
+    """Classify a list of messages with classifier's batch interface.
+
+    If the batch as a whole fails, fall back to classifying the
+    messages individually, so that errors can be attributed to
+    specific messages.  Returns a list of (isspam, score) tuples, or
+    a NotspamClassificationError for messages that failed (including
+    NotspamTimeoutError for messages that timed out).
+
+    """
+    try:
+        return classify.classify_batch(msgs)
+    except NotspamClassificationError as e:
+        if len(msgs) == 1:
+            return [e]
+    results = []
+    for msg in msgs:
+        try:
+            results.append(classify(msg))
+        except NotspamClassificationError as e:
+            results.append(e)
+    return results
+
+def classify(classifier, query_string, spam_tags=[], ham_tags=[], unk_tags=[], dry=True,
+             batch_size=_DEFAULT_BATCH_SIZE, jobs=1, cache=True, since_last_run=False,
+             atomic_size=_DEFAULT_ATOMIC_SIZE, executor=None, dedup=False, shards=1,
+             stream=False, window=None, prefilter=False, threads=None):
     """Classify specified messages and apply tags appropriately.
 
     'classifier' is classifier module imported with
@@ -222,88 +1494,1002 @@ def classify(classifier, query_string, spam_tags=[], ham_tags=[], unk_tags=[], d
     '*_tags" are lists of tags to be applied to the classified
     messages.  If 'dry' is True, messages will not be tagged.
 
-    Returns the tuple (nmsgs, nham, nspam, nunk) where:
-      nmsgs   total number of messages in search
-      nham    number of ham messages
-      hspam   number of spam messages
-      nunk    number of unknown messages
+    Messages are handed to the classifier in batches of up to
+    'batch_size' messages.  If 'jobs' is greater than one, batches are
+    classified concurrently by that many worker threads, each with
+    its own classifier instance; tagging is always done from the
+    calling thread.  The workers run on 'executor' if given (a
+    concurrent.futures.Executor with at least 'jobs' workers), or on
+    a new thread pool otherwise.
+
+    The messages are classified with the database opened read-only;
+    if tags are to be applied, the database is then reopened
+    READ_WRITE just long enough to apply them, skipping any messages
+    modified in the meantime.  Tag changes are committed in atomic
+    sections of up to 'atomic_size' messages.
+
+    If 'cache' is True, results are looked up in and stored to the
+    default ResultCache; a ResultCache object may also be passed, or
+    False to disable caching.  If 'since_last_run' is True, only
+    messages modified since the last (non-dry) run with the same
+    query string and classifier are classified.  If 'dedup' is True,
+    only the first of messages with the same content (see
+    content_digest()) is classified, and its result applied to the
+    others.
+
+    If 'prefilter' is True, a Prefilter is built from the database at
+    the start of the run, and messages it decides (e.g. from people
+    we have written to) are tagged without being classified; a
+    Prefilter object may also be passed.
+
+    If 'threads' is given, messages are taken thread by thread (see
+    _thread_messages()), and the first message of each thread is
+    classified on its own.  If its verdict is confident by the
+    ThreadPolicy, the verdict is applied to the rest of the thread
+    without classifying them.  So are confident cached or prefiltered
+    results, and threads with our sent mail in them are ham.
+    'threads' is a ThreadPolicy spec (or True for the default 'ham'
+    policy), or a ThreadPolicy object.  'stream' and 'window' do not
+    apply.
+
+    If 'shards' is greater than one, the search is split into that
+    many disjoint date ranges of about equal size, each classified by
+    its own worker process with its own database handle and
+    classifier instances (and 'jobs' threads).  The workers return
+    their tag changes, which are applied from the calling process
+    (see _classify_sharded()).
+
+    If 'stream' is True, the search is neither counted nor sorted
+    first (see _search()), and progress is logged as a rate.  If
+    'window' is given, the search is iterated that many messages at a
+    time, to bound memory use (see _windowed()).
+
+    Returns a Stats object, with counts:
+      msgs        total number of messages in search
+      ham         number of ham messages
+      spam        number of spam messages
+      unknown     number of unknown messages
+      errors      number of messages that failed classification
+      cached      number of results found in the cache
+      duplicates  number of duplicate messages not classified
+      prefiltered number of messages decided by the prefilter
+      threaded    number of messages given their thread's verdict
+      changed     number of messages whose tags were changed
+      skipped     number of messages not tagged as they were
+                  modified during classification
+      <classifier>.<key>
+                  the classifier's own counts, if it keeps any
+                  (e.g. 'cascade.bogofilter', the number of messages
+                  run through the cascade's bogofilter stage)
 
     """
-    classify = classifier.Classifier()
-
-    if dry:
-        mode = 0
+    if shards > 1:
+        return _classify_sharded(classifier, query_string, shards,
+                                 spam_tags=spam_tags, ham_tags=ham_tags, unk_tags=unk_tags,
+                                 dry=dry, batch_size=batch_size, jobs=jobs, cache=cache,
+                                 since_last_run=since_last_run, atomic_size=atomic_size,
+                                 dedup=dedup, stream=stream, window=window,
+                                 prefilter=prefilter, threads=threads)
+
+    if cache is True:
+        with ResultCache() as cache:
+            return classify(classifier, query_string,
+                            spam_tags=spam_tags, ham_tags=ham_tags, unk_tags=unk_tags,
+                            dry=dry, batch_size=batch_size, jobs=jobs, cache=cache,
+                            since_last_run=since_last_run, atomic_size=atomic_size,
+                            executor=executor, dedup=dedup, stream=stream, window=window,
+                            prefilter=prefilter, threads=threads)
+
+    import notmuch
+    stats = Stats()
+    cname = _classifier_name(classifier)
+
+    # classify with the database open READ_ONLY, so as not to hold the
+    # write lock for the duration of the run
+    with stats.phase('open'):
+        db = notmuch.Database(mode=0, path=os.environ.get('MAILDIR', None))
+    with db:
+        revision, uuid = db.get_revision()
+        search_string = query_string
+        if since_last_run:
+            search_string = _since_last_run(query_string, cname, uuid, revision)
+        if prefilter is True:
+            with stats.phase('prefilter'):
+                prefilter = Prefilter(db)
+        threads = _thread_policy(db, threads, stats)
+        changes = _scan(classifier, db, search_string, stats,
+                        spam_tags=spam_tags, ham_tags=ham_tags, unk_tags=unk_tags,
+                        dry=dry, batch_size=batch_size, jobs=jobs, cache=cache,
+                        executor=executor, dedup=dedup, stream=stream, window=window,
+                        prefilter=prefilter, threads=threads)
+
+    _finish_run(stats, changes, query_string, cname, revision, uuid,
+                since_last_run=since_last_run, dry=dry, atomic_size=atomic_size)
+    return stats.finish()
+
+def _thread_policy(db, threads, stats):
+    # ThreadPolicy for classify() 'threads' argument, or None
+    if not threads or isinstance(threads, ThreadPolicy):
+        return threads or None
+    with stats.phase('threads'):
+        if threads is True:
+            return ThreadPolicy(db)
+        return ThreadPolicy(db, threads)
+
+def _since_last_run(query_string, cname, uuid, revision, key=None):
+    # search string restricted to messages modified since the last
+    # run (recorded in RunState under 'key', by default the query
+    # string), up to 'revision'
+    with RunState() as state:
+        last = state.get(key or query_string, cname)
+    # lastmod revisions are only meaningful for the same database, so
+    # do a full run if the UUID has changed
+    if last and last[0] == uuid:
+        return '(%s) and (lastmod:%d..%d)' % (query_string, last[1]+1, revision)
+    return query_string
+
+def _scan(classifier, db, search_string, stats, spam_tags=[], ham_tags=[], unk_tags=[],
+          dry=True, batch_size=_DEFAULT_BATCH_SIZE, jobs=1, cache=False, executor=None,
+          dedup=False, stream=False, window=None, prefilter=None, threads=None):
+    # classify messages in search, updating 'stats'.  Returns the tag
+    # changes to apply, as a list of (msg-id, tags).
+    import concurrent.futures
+    local = threading.local()
+
+    def work(batch):
+        t = time.perf_counter()
+        if not hasattr(local, 'classify'):
+            local.classify = classifier.Classifier()
+        # classifier's own counts, which may be kept across runs
+        before = collections.Counter(getattr(local.classify, 'counts', None))
+        results = _classify_batch(local.classify, batch)
+        counts = collections.Counter(getattr(local.classify, 'counts', None)) - before
+        return results, time.perf_counter() - t, counts
+
+    cname = _classifier_name(classifier)
+    if cache:
+        cache_name, generation = _cache_key(cache, classifier)
+
+    changes = []
+
+    if threads:
+        if stream or window:
+            raise ValueError("thread-aware classification can not stream or window the search")
+        msgs, nmsgs = _thread_messages(db, search_string, stats)
     else:
-        mode = 1
+        msgs, nmsgs = _search(db, search_string, stats, stream=stream, window=window)
+    progress = _Progress(nmsgs)
+    nmsg = 0
+
+    # results by content digest, for dedup.  None while the first
+    # message with the digest is still being classified.
+    digests = {}
+    # digest of messages handed to the classifier, by message-id
+    msg_digests = {}
+    # thread of representative messages handed to the classifier, by
+    # message-id, and messages of threads the representative left
+    # undecided, to be classified once the search is done
+    msg_threads = {}
+    deferred = []
+
+    def lookup(batch):
+        # known results for batch (prefilter or cached results, or
+        # the digest of a duplicate message), and the messages to
+        # classify
+        known = [None] * len(batch)
+        if prefilter:
+            with stats.phase('prefilter'):
+                known = [prefilter.check(msg) for msg in batch]
+            stats.counts['prefiltered'] += len(batch) - known.count(None)
+        if cache:
+            with stats.phase('cache'):
+                for i, msg in enumerate(batch):
+                    if known[i] is None:
+                        known[i] = cache.get(msg.get_message_id(), cache_name, generation)
+                        if known[i] is not None:
+                            stats.counts['cached'] += 1
+        if threads:
+            with stats.phase('threads'):
+                for i, msg in enumerate(batch):
+                    tid = msg.get_thread_id()
+                    if known[i] is not None:
+                        threads.decide(tid, known[i])
+                    elif tid in threads.verdicts:
+                        known[i] = threads.verdicts[tid]
+                        stats.counts['threaded'] += 1
+                    elif tid in threads.pending:
+                        # wait for the representative's verdict
+                        known[i] = tid
+                    elif tid not in threads.undecided:
+                        threads.pending.add(tid)
+                        msg_threads[msg.get_message_id()] = tid
+        if dedup:
+            with stats.phase('dedup'):
+                for i, msg in enumerate(batch):
+                    if known[i] is not None:
+                        continue
+                    digest = _digest(msg)
+                    if digest is None:
+                        continue
+                    if digest in digests:
+                        known[i] = digest
+                        stats.counts['duplicates'] += 1
+                    else:
+                        digests[digest] = None
+                        msg_digests[msg.get_message_id()] = digest
+        return known, [msg for msg, hit in zip(batch, known) if hit is None]
+
+    def process(batch, known, results, elapsed, counts):
+        nonlocal nmsg
+
+        if results:
+            stats.latency.add(elapsed/len(results), len(results))
+        for key, n in counts.items():
+            stats.counts['%s.%s' % (cname, key)] += n
+
+        results = iter(results)
+        cached = []
+        for msg, result in zip(batch, known):
+            if isinstance(result, str):
+                # later message of a thread whose representative was
+                # classified earlier
+                if result not in threads.verdicts:
+                    deferred.append(msg)
+                    continue
+                result = threads.verdicts[result]
+                stats.counts['threaded'] += 1
 
-    # open the database READ.WRITE
-    with notmuch.Database(mode=mode, path=os.environ.get('MAILDIR', None)) as db:
-        query = db.create_query(query_string)
-        nmsgs = query.count_messages()
-        nmsg = 0
-        nham = 0
-        nspam = 0
-        nunk = 0
-
-        for msg in query.search_messages():
             nmsg += 1
 
-            logmsg = '%d/%d' % (nmsg, nmsgs)
-            _logproc(logmsg+' id:%s' % (msg.get_message_id()), end='\r')
-
-            try:
-                isspam, cmsg = classify(msg)
-            except NotspamClassificationError as e:
+            if result is None:
+                result = next(results)
+                digest = msg_digests.pop(msg.get_message_id(), None)
+                if digest is not None:
+                    digests[digest] = result
+                if cache and not isinstance(result, NotspamClassificationError):
+                    cached.append((msg.get_message_id(),) + tuple(result))
+            elif isinstance(result, bytes):
+                # duplicate of a message classified earlier
+                result = digests[result]
+
+            tid = msg_threads.pop(msg.get_message_id(), None)
+            if tid is not None:
+                # representative of its thread
+                threads.pending.discard(tid)
+                if not threads.decide(tid, result):
+                    threads.undecided.add(tid)
+
+            if isinstance(result, NotspamTimeoutError):
+                # unknown, but not cached, so it is tried again by
+                # the next run
+                result = (None, 'timeout')
+            if isinstance(result, NotspamClassificationError):
                 print("Classification error: id:%s" % (msg.get_message_id()), file=sys.stderr)
-                print("  %s" % e, file=sys.stderr)
-                continue
+                print("  %s" % result, file=sys.stderr)
+                stats.counts['errors'] += 1
                 continue
-            except:
-                print("Fatal error: id:%s" % (msg.get_message_id()), file=sys.stderr)
-                raise
+            isspam, cmsg = result
 
             if isspam is None:
                 flag = '?'
                 tags = unk_tags
-                nunk += 1
+                stats.counts['unknown'] += 1
             elif isspam:
                 flag = 'SPAM'
                 tags = spam_tags
-                nspam += 1
+                stats.counts['spam'] += 1
             else:
                 flag = 'HAM'
                 tags = ham_tags
-                nham += 1
+                stats.counts['ham'] += 1
 
-            logmsg += ' %s' % (flag)
+            logmsg = '%s %s' % (progress(nmsg), flag)
             if cmsg:
                 logmsg += ' (%s)' % cmsg
             if not dry:
                 logmsg += ' %s' % (tags)
-                _tag_msg(msg, tags)
+                add, remove = Tagger.diff(msg, tags)
+                if add or remove:
+                    changes.append((msg.get_message_id(), tags))
             logmsg += ' id:%s     ' % (msg.get_message_id())
 
             _logproc(logmsg)
 
-        return nmsgs, nham, nspam, nunk
+        if cached:
+            with stats.phase('cache'):
+                cache.put(cache_name, generation, cached)
 
-def _classify(*args, **kwargs):
-    t = time.time()
-    nmsgs, nham, nspam, nunk = classify(*args, **kwargs)
-    t = time.time() - t
+    def finish(batch, known, future):
+        try:
+            with stats.phase('classify'):
+                results, elapsed, counts = future.result()
+        except:
+            print("Fatal error: id:%s" % (batch[0].get_message_id()), file=sys.stderr)
+            raise
+        process(batch, known, results, elapsed, counts)
+
+    msgs = stats.timed('query', msgs)
+    if jobs > 1:
+        # keep a bounded number of batches in flight, and collect
+        # them in order so that logging and tagging stay ordered.
+        pending = collections.deque()
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(max_workers=jobs))
+            for batch in _batches(msgs, batch_size):
+                _logproc('%s id:%s' % (progress(nmsg+len(batch)), batch[-1].get_message_id()), end='\r')
+                known, misses = lookup(batch)
+                refs = [_MessageRef(msg) for msg in misses]
+                pending.append((batch, known, executor.submit(work, refs)))
+                while len(pending) > 2*jobs:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+    else:
+        for batch in _batches(msgs, batch_size):
+            _logproc('%s id:%s' % (progress(nmsg+len(batch)), batch[-1].get_message_id()), end='\r')
+            known, misses = lookup(batch)
+            try:
+                with stats.phase('classify'):
+                    results, elapsed, counts = work(misses) if misses else ([], 0, {})
+            except:
+                print("Fatal error: id:%s" % (misses[0].get_message_id()), file=sys.stderr)
+                raise
+            process(batch, known, results, elapsed, counts)
+
+    for batch in _batches(deferred, batch_size):
+        try:
+            with stats.phase('classify'):
+                results, elapsed, counts = work([_MessageRef(msg) for msg in batch])
+        except:
+            print("Fatal error: id:%s" % (batch[0].get_message_id()), file=sys.stderr)
+            raise
+        process(batch, [None] * len(batch), results, elapsed, counts)
+
+    stats.counts['msgs'] = nmsg
+    return changes
+
+def _finish_run(stats, changes, query_string, cname, revision, uuid,
+                since_last_run=False, dry=True, atomic_size=_DEFAULT_ATOMIC_SIZE):
+    # apply tag changes from scan at 'revision', and record the run
+    if changes:
+        with stats.phase('tag'):
+            nchanged, nskipped, modified, end_revision, end_uuid = _apply_tags(
+                changes, revision, atomic_size=atomic_size)
+        stats.counts['changed'] = nchanged
+        stats.counts['skipped'] = nskipped
+        if nskipped:
+            print("skipped tagging %d messages modified during classification" % nskipped,
+                  file=sys.stderr)
+        if not modified and end_uuid == uuid:
+            # nothing but our own tagging changed the database since
+            # the scan, so record the revision after tagging, so that
+            # our tag changes are not picked up by the next run.
+            # Otherwise (e.g. mail delivered during the scan) keep the
+            # scan's revision, so the next run sees those messages.
+            revision = end_revision
+
+    if since_last_run and not dry:
+        with RunState() as state:
+            state.put(query_string, cname, uuid, revision)
+
+def _shard_ranges(db, search_string, shards):
+    """Split search into date ranges of about equal message counts.
+
+    Returns a list of up to 'shards' notmuch 'date:' range terms which
+    together cover all time, so every message in the search falls in
+    exactly one of them.  Range boundaries are found by bisecting on
+    message counts, which notmuch answers from its index.
+
+    """
+    import notmuch
+    def count(term):
+        return db.create_query('(%s) and (%s)' % (search_string, term)).count_messages()
+    def date(sort):
+        query = db.create_query(search_string)
+        query.set_sort(sort)
+        for msg in query.search_messages():
+            return msg.get_date()
+    total = db.create_query(search_string).count_messages()
+    if total == 0:
+        return ['date:..']
+    first = date(notmuch.Query.SORT.OLDEST_FIRST)
+    last = date(notmuch.Query.SORT.NEWEST_FIRST)
+    # boundaries are the first second of each shard after the first.
+    # Each shard is aimed at an equal part of the messages left after
+    # the previous one, so that the rest are still split evenly after
+    # a shard that ran over (e.g. many messages in the same second).
+    # Shards that would be empty are dropped.
+    bounds = []
+    nprev = 0
+    for k in range(1, shards):
+        target = nprev + (total - nprev) // (shards - k + 1)
+        lo = first
+        hi = last
+        # smallest time t with at least target messages up to t
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if count('date:..@%d' % mid) >= target:
+                hi = mid
+            else:
+                lo = mid + 1
+        n = count('date:..@%d' % lo)
+        if lo < last and n > nprev:
+            bounds.append(lo + 1)
+            nprev = n
+    ranges = []
+    start = ''
+    for bound in bounds:
+        ranges.append('date:%s..@%d' % (start, bound - 1))
+        start = '@%d' % bound
+    ranges.append('date:%s..' % start)
+    return ranges
+
+class _DeferredCache(object):
+    # ResultCache of a shard worker: results are looked up in the
+    # cache, but new results are only collected, for the parent to
+    # write, so that workers do not contend for the cache's write lock.
+    def __init__(self, path):
+        self.cache = ResultCache(path, max_age=None, max_entries=None)
+        self.results = []
+
+    def generation(self, classifier):
+        return self.cache.generation(classifier)
+
+    def get(self, msgid, classifier, generation):
+        return self.cache.get(msgid, classifier, generation)
+
+    def put(self, classifier, generation, results):
+        self.results.append((classifier, generation, results))
+
+    def close(self):
+        self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _classify_shard(module_name, search_string, cache_path, kwargs):
+    # worker process: scan one shard, returning the stats (as a dict),
+    # tag changes and results to cache
+    import notmuch
+    import importlib
+    classifier = importlib.import_module(module_name)
+    stats = Stats()
+    with contextlib.ExitStack() as stack:
+        cache = False
+        if cache_path:
+            cache = stack.enter_context(_DeferredCache(cache_path))
+        with stats.phase('open'):
+            db = notmuch.Database(mode=0, path=os.environ.get('MAILDIR', None))
+        with db:
+            changes = _scan(classifier, db, search_string, stats, cache=cache, **kwargs)
+    return stats.finish().as_dict(), changes, cache.results if cache else []
+
+def _classify_sharded(classifier, query_string, shards, spam_tags=[], ham_tags=[], unk_tags=[],
+                      dry=True, batch_size=_DEFAULT_BATCH_SIZE, jobs=1, cache=True,
+                      since_last_run=False, atomic_size=_DEFAULT_ATOMIC_SIZE, dedup=False,
+                      stream=False, window=None, prefilter=False, threads=None):
+    """Classify search split into shards, one worker process each.
+
+    The search is split with _shard_ranges(), and each shard scanned
+    by a worker process (see classify()).  This process is the single
+    writer: it applies the tag changes returned by all workers,
+    skipping any message modified since the search was split, and
+    caches the results they return.  The
+    worker stats are merged, so phase times are summed over workers.
+    Duplicates are only detected within a shard.  The prefilter and
+    thread policy are built once, here, and handed to every worker,
+    but thread verdicts are only propagated within a shard.
+
+    """
+    import notmuch
+    import concurrent.futures
+    stats = Stats()
+    cname = _classifier_name(classifier)
+
+    with stats.phase('open'):
+        db = notmuch.Database(mode=0, path=os.environ.get('MAILDIR', None))
+    with db:
+        revision, uuid = db.get_revision()
+        search_string = query_string
+        if since_last_run:
+            search_string = _since_last_run(query_string, cname, uuid, revision)
+        if prefilter is True:
+            with stats.phase('prefilter'):
+                prefilter = Prefilter(db)
+        threads = _thread_policy(db, threads, stats)
+        with stats.phase('shard'):
+            ranges = _shard_ranges(db, search_string, shards)
+
+    kwargs = dict(spam_tags=spam_tags, ham_tags=ham_tags, unk_tags=unk_tags,
+                  dry=dry, batch_size=batch_size, jobs=jobs, dedup=dedup, stream=stream,
+                  window=window, prefilter=prefilter, threads=threads)
+    changes = []
+    with contextlib.ExitStack() as stack:
+        # workers only read the cache; their results are written here
+        cache_path = None
+        if cache is True:
+            cache = stack.enter_context(ResultCache())
+        if cache:
+            cache_path = cache.path
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges)))
+        futures = [executor.submit(_classify_shard, classifier.__name__,
+                                   '(%s) and (%s)' % (search_string, r), cache_path, kwargs)
+                   for r in ranges]
+        for future in futures:
+            sstats, schanges, sresults = future.result()
+            stats.merge(Stats.from_dict(sstats))
+            changes += schanges
+            with stats.phase('cache'):
+                for args in sresults:
+                    cache.put(*args)
+
+    _finish_run(stats, changes, query_string, cname, revision, uuid,
+                since_last_run=since_last_run, dry=dry, atomic_size=atomic_size)
+    return stats.finish()
+
+def _classify_summary(stats):
+    nmsgs = stats.counts['msgs']
+    nham = stats.counts['ham']
+    nspam = stats.counts['spam']
+    nunk = stats.counts['unknown']
     pham = pspam = punk = 0.0
     if nmsgs:
         pham = nham*100/nmsgs
         pspam = nspam*100/nmsgs
         punk = nunk*100/nmsgs
-    print('classified %d messages is %.2fs (%.2f msgs/s): %d ham (%.2f%%), %d spam (%.2f%%), %d unknown (%.2f%%)' % (
+    summary = 'classified %d messages is %.2fs (%.2f msgs/s): %d ham (%.2f%%), %d spam (%.2f%%), %d unknown (%.2f%%), %d tagged' % (
         nmsgs,
-        t,
-        nmsgs/t,
+        stats.elapsed,
+        nmsgs/stats.elapsed,
         nham, pham,
         nspam, pspam,
-        nunk, punk),
-          file=sys.stderr)
+        nunk, punk,
+        stats.counts['changed'])
+    if stats.counts['duplicates']:
+        summary += ', %d duplicates' % stats.counts['duplicates']
+    if stats.counts['prefiltered']:
+        summary += ', %d prefiltered' % stats.counts['prefiltered']
+    if stats.counts['threaded']:
+        summary += ', %d by thread' % stats.counts['threaded']
+    # classifier's own counts, e.g. cascade stages
+    own = collections.defaultdict(list)
+    for key, n in sorted(stats.counts.items()):
+        if '.' in key:
+            prefix, key = key.split('.', 1)
+            own[prefix].append('%s %d' % (key, n))
+    for prefix, counts in own.items():
+        summary += '; %s: %s' % (prefix, ', '.join(counts))
+    print(summary, file=sys.stderr)
+
+def _classify(*args, **kwargs):
+    stats = _profile(classify, *args, **kwargs)
+    _classify_summary(stats)
+    return stats
+
+############################################################
+
+# classifiers whose state can not be kept apart per fold: spamd keeps
+# its own
+_SHARED_STATE = ['spamassassin', 'cascade']
+
+def _id_query(msgids):
+    # notmuch query string matching any of the message-ids
+    terms = []
+    for msgid in msgids:
+        if any(c in msgid for c in ' "()'):
+            msgid = '"%s"' % msgid.replace('"', '""')
+        terms.append('id:%s' % msgid)
+    return ' or '.join(terms)
+
+def _id_queries(msgids, size=500):
+    # _id_query() strings for the message-ids, 'size' ids at a time,
+    # so that no query has too many terms for Xapian
+    for i in range(0, len(msgids), size):
+        yield _id_query(msgids[i:i+size])
+
+@contextlib.contextmanager
+def _isolated(path, maildir):
+    # environment with classifier state, and the notspam cache, kept
+    # under 'path'.  The database is found by MAILDIR, as the notmuch
+    # config may be under the real HOME.
+    env = {
+        'HOME': path,
+        'XDG_CACHE_HOME': os.path.join(path, '.cache'),
+        'XDG_DATA_HOME': os.path.join(path, '.local', 'share'),
+        'NOTSPAM_CACHE_DIR': os.path.join(path, 'notspam'),
+        'NOTSPAM_NATIVE_DB': os.path.join(path, 'native.db'),
+        'BOGOFILTER_DIR': os.path.join(path, '.bogofilter'),
+        'MAILDIR': maildir,
+        }
+    config = os.getenv('NOTMUCH_CONFIG', os.path.expanduser('~/.notmuch-config'))
+    if os.path.exists(config):
+        env['NOTMUCH_CONFIG'] = config
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def _evaluate_backend(classifier, queries, folds, batch_size=_DEFAULT_BATCH_SIZE, jobs=1,
+                      maildir=None):
+    # cross-validate one classifier, returning its result dict
+    import tempfile
+    counts = collections.Counter()
+    cstats = Stats()
+    ntrained = 0
+    train_elapsed = 0.0
+    for k in range(folds):
+        with tempfile.TemporaryDirectory(prefix='notspam-evaluate-') as tmp, \
+             _isolated(tmp, maildir):
+            for meat in ['spam', 'ham']:
+                query_string, msgids = queries[meat]
+                train_ids = [msgid for i, msgid in enumerate(msgids) if i % folds != k]
+                for id_query in _id_queries(train_ids):
+                    stats = train(classifier, meat, '(%s) and (%s)' % (query_string, id_query),
+                                  batch_size=batch_size, journal=False, dry=True)
+                    ntrained += stats.counts['trained']
+                    train_elapsed += stats.elapsed
+            for meat in ['spam', 'ham']:
+                query_string, msgids = queries[meat]
+                test_ids = [msgid for i, msgid in enumerate(msgids) if i % folds == k]
+                for id_query in _id_queries(test_ids):
+                    stats = classify(classifier, '(%s) and (%s)' % (query_string, id_query),
+                                     batch_size=batch_size, jobs=jobs, cache=False, dry=True)
+                    cstats.merge(stats)
+                    cstats.elapsed += stats.elapsed
+                    for key in ['spam', 'ham', 'unknown', 'errors']:
+                        counts['%s.%s' % (meat, key)] += stats.counts[key]
+
+    nspam = len(queries['spam'][1])
+    nham = len(queries['ham'][1])
+    tp = counts['spam.spam']
+    fp = counts['ham.spam']
+    nmsgs = nspam + nham
+    return {
+        'backend': _classifier_name(classifier),
+        'spam': nspam,
+        'ham': nham,
+        'true_positives': tp,
+        'false_positives': fp,
+        'false_negatives': nspam - tp,
+        'unknown': counts['spam.unknown'] + counts['ham.unknown'],
+        'errors': counts['spam.errors'] + counts['ham.errors'],
+        'precision': tp / (tp + fp) if tp + fp else None,
+        'recall': tp / nspam if nspam else None,
+        'false_positive_rate': fp / nham if nham else None,
+        'msgs_per_s': nmsgs / cstats.elapsed if cstats.elapsed else None,
+        'train_msgs_per_s': ntrained / train_elapsed if train_elapsed else None,
+        'latency': cstats.latency.as_dict(),
+        }
+
+def evaluate(spam_query, ham_query, backends=None, folds=_DEFAULT_FOLDS,
+             batch_size=_DEFAULT_BATCH_SIZE, jobs=1):
+    """Cross-validate classifiers on labelled messages.
+
+    Messages matching 'spam_query' but not 'ham_query' are labelled
+    spam, and the other way round for ham.  Each meat is split into
+    'folds' folds (by message-id hash, so the same labels always give
+    the same folds).  For each fold, the classifier is trained with
+    train() on the other folds, with its state kept in a fresh
+    temporary directory (see _isolated()), and the fold is then
+    classified with classify().  Nothing is tagged, and neither the
+    training journal nor the result cache are used.
+
+    'backends' is a list of classifier names, by default every
+    available classifier but those whose state can not be isolated
+    (spamassassin and cascade).  A backend that fails is reported
+    with an 'error'.
+
+    Returns a report dict, with 'params' and a list of 'results', one
+    per backend: the numbers of spam and ham messages, true and false
+    positives, false negatives (including unknown), unknown and
+    errors, precision, recall, false positive rate, classification
+    and training msgs/s, and the classify() latency histogram (see
+    Histogram.as_dict()).
+
+    """
+    import hashlib
+    import notmuch
+    if folds < 2:
+        raise ValueError("need at least 2 folds")
+    if backends is None:
+        backends = [name for name in notspam_classifiers.classifiers_list()
+                    if name not in _SHARED_STATE]
+
+    db = notmuch.Database(mode=0, path=os.environ.get('MAILDIR', None))
+    with db:
+        maildir = db.get_path()
+        queries = {}
+        for meat, query_string, other in [('spam', spam_query, ham_query),
+                                          ('ham', ham_query, spam_query)]:
+            query_string = '(%s) and not (%s)' % (query_string, other)
+            query = db.create_query(query_string)
+            msgids = [msg.get_message_id() for msg in query.search_messages()]
+            del query
+            # fold i % folds of the message-ids in hash order
+            msgids.sort(key=lambda msgid: hashlib.sha1(msgid.encode()).digest())
+            queries[meat] = (query_string, msgids)
+
+    results = []
+    for name in backends:
+        try:
+            classifier = import_classifier(name)
+        except (ImportError, AttributeError) as e:
+            print("%s: skipped (%s)" % (name, e), file=sys.stderr)
+            continue
+        try:
+            result = _evaluate_backend(classifier, queries, folds, batch_size=batch_size,
+                                       jobs=jobs, maildir=maildir)
+        except Exception as e:
+            print("%s: failed (%s: %s)" % (name, type(e).__name__, e), file=sys.stderr)
+            result = {'backend': name, 'error': '%s: %s' % (type(e).__name__, e)}
+        results.append(result)
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'version': __VERSION__,
+        'params': {
+            'spam_query': spam_query,
+            'ham_query': ham_query,
+            'folds': folds,
+            'batch': batch_size,
+            'jobs': jobs,
+            },
+        'results': results,
+        }
+
+def _evaluate_summary(report):
+    def fmt(value, spec='%.4f'):
+        return 'n/a' if value is None else spec % value
+    for r in report['results']:
+        if 'error' in r:
+            continue
+        print("%s: precision %s, recall %s, false positive rate %s, %d unknown, %d errors,"
+              " %s msgs/s, p50 %s ms, p99 %s ms" % (
+                  r['backend'],
+                  fmt(r['precision']),
+                  fmt(r['recall']),
+                  fmt(r['false_positive_rate']),
+                  r['unknown'],
+                  r['errors'],
+                  fmt(r['msgs_per_s'], '%.2f'),
+                  fmt(r['latency']['p50'] and r['latency']['p50'] * 1000, '%.3f'),
+                  fmt(r['latency']['p99'] and r['latency']['p99'] * 1000, '%.3f')),
+              file=sys.stderr)
+
+############################################################
+
+def startup_bench(budget=_STARTUP_BUDGET, runs=5):
+    """Check time to import notspam against budget in milliseconds.
+
+    notspam is imported in fresh interpreters 'runs' times, and the
+    fastest time taken, to discount noise.  Importing must also not
+    have imported notmuch or any classifier.  Returns True if within
+    budget.
+
+    """
+    import subprocess
+    code = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        "import notspam\n"
+        "t = time.perf_counter() - t\n"
+        "eager = [m for m in sys.modules if m == 'notmuch' or m.startswith('notspam_classifiers.')]\n"
+        "print(t * 1000, ','.join(sorted(eager)))\n"
+        )
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join([path] + [p for p in [env.get('PYTHONPATH')] if p])
+    times = []
+    for i in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env).decode().split()
+        times.append(float(out[0]))
+        eager = out[1].split(',') if len(out) > 1 else []
+    best = min(times)
+    print("import notspam: %.1fms (budget %dms, %d runs)" % (best, budget, runs), file=sys.stderr)
+    if eager:
+        print("eagerly imported: %s" % ' '.join(eager), file=sys.stderr)
+    return best <= budget and not eager
+
+############################################################
+
+def _socket_path():
+    """Path of the notspam daemon socket.
+
+    NOTSPAM_SOCKET if set, or notspam.sock in $XDG_RUNTIME_DIR (or
+    the cache directory, if that is not set).
+
+    """
+    path = os.getenv('NOTSPAM_SOCKET')
+    if path:
+        return path
+    rundir = os.getenv('XDG_RUNTIME_DIR')
+    if rundir:
+        return os.path.join(rundir, 'notspam.sock')
+    return _cache_path('notspam.sock')
+
+class _WarmClassifier(object):
+    """Classifier module stand-in that reuses classifier instances.
+
+    Each thread gets a single Classifier instance, which is kept
+    rather than created for every run, until the model generation in
+    the ResultCache changes.  Instances may hold on to the model they
+    were created with (e.g. the native token store), so they are
+    replaced once the classifier has been trained, by the daemon or
+    otherwise.
+
+    """
+    def __init__(self, module):
+        self.__name__ = module.__name__
+        self.Trainer = module.Trainer
+        self.__module = module
+        self.__local = threading.local()
+
+    def __getattr__(self, name):
+        # the module's optional functions, e.g. models()
+        return getattr(self.__module, name)
+
+    def Classifier(self):
+        # no eviction, as this is only a lookup
+        with ResultCache(max_age=None, max_entries=None) as cache:
+            generation = _cache_key(cache, self)[1]
+        local = self.__local
+        if not hasattr(local, 'classifier') or local.generation != generation:
+            local.classifier = self.__module.Classifier()
+            local.generation = generation
+        return local.classifier
+
+def serve(classifier, path=None):
+    """Serve classify and train requests on a unix socket.
+
+    'classifier' is classifier module imported with
+    import_classifier().  The classifier instances, any backend
+    connections and the worker threads are kept warm between
+    requests.  The database is opened afresh for each request, as a
+    read-only handle only sees the database as it was when opened.
+
+    Requests and responses are single lines of JSON.  A request is an
+    object with 'cmd' ('classify', 'train' or 'ping'), 'classifier'
+    (which must match the served classifier), the 'query' string,
+    'meat' for train, and 'kwargs' for classify() or train().  The
+    response holds either the run 'stats' (see Stats.as_dict()), or
+    an 'error' string.
+
+    Requests are handled one at a time.
+
+    """
+    import json
+    import socket
+    import traceback
+    import concurrent.futures
+    if path is None:
+        path = _socket_path()
+    cname = _classifier_name(classifier)
+    warm = _WarmClassifier(classifier)
+    executor = None
+    njobs = 0
+
+    if os.path.exists(path):
+        if _request({'cmd': 'ping'}, path) is not None:
+            sys.exit("notspam daemon already running on %s." % path)
+        os.unlink(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # exit cleanly on signals, so that the socket is removed
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(sig, lambda signum, frame: sys.exit(0))
+    try:
+        # only we may connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+        print("serving %s on %s" % (cname, path), file=sys.stderr)
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                try:
+                    request = json.loads(conn.makefile('rb').readline().decode())
+                    cmd = request['cmd']
+                    if cmd == 'ping':
+                        response = {'classifier': cname}
+                    elif request.get('classifier') != cname:
+                        response = {'error': "daemon is serving classifier '%s'" % cname}
+                    elif cmd == 'classify':
+                        kwargs = request.get('kwargs', {})
+                        jobs = kwargs.get('jobs', 1)
+                        if jobs > njobs:
+                            if executor:
+                                executor.shutdown()
+                            executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+                            njobs = jobs
+                        stats = classify(warm, request['query'], executor=executor, **kwargs)
+                        _classify_summary(stats)
+                        response = {'stats': stats.as_dict()}
+                    elif cmd == 'train':
+                        kwargs = request.get('kwargs', {})
+                        stats = train(warm, request['meat'], request['query'], **kwargs)
+                        _train_summary(stats, request['meat'], kwargs.get('retrain', False))
+                        response = {'stats': stats.as_dict()}
+                    else:
+                        response = {'error': "unknown command '%s'" % cmd}
+                except Exception as e:
+                    traceback.print_exc()
+                    response = {'error': '%s: %s' % (type(e).__name__, e)}
+                try:
+                    conn.sendall(bytes(json.dumps(response) + '\n', 'UTF-8'))
+                except OSError:
+                    pass
+    finally:
+        sock.close()
+        os.unlink(path)
+        if executor:
+            executor.shutdown()
+
+def _request(request, path=None):
+    """Send request to notspam daemon and return the response.
+
+    Returns None if no daemon is listening, or if it does not answer
+    within NOTSPAM_DAEMON_TIMEOUT seconds (e.g. if it is wedged).
+
+    """
+    import json
+    import socket
+    if path is None:
+        path = _socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(float(os.getenv('NOTSPAM_DAEMON_TIMEOUT', _DAEMON_TIMEOUT)) or None)
+    with sock:
+        try:
+            sock.connect(path)
+            sock.sendall(bytes(json.dumps(request) + '\n', 'UTF-8'))
+            response = sock.makefile('rb').readline()
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        except socket.timeout:
+            print("daemon timed out", file=sys.stderr)
+            return None
+        return json.loads(response.decode())
+
+def _via_daemon(cmd, classifier_name, query_string, meat=None, **kwargs):
+    """Run classify or train request through the daemon.
+
+    Returns the run Stats, or None if no daemon is running or the
+    daemon could not handle the request, in which case the caller
+    should fall back to doing the work in-process.
+
+    """
+    request = {
+        'cmd': cmd,
+        'classifier': classifier_name,
+        'query': query_string,
+        'kwargs': kwargs,
+        }
+    if meat:
+        request['meat'] = meat
+    try:
+        response = _request(request)
+    except (OSError, ValueError) as e:
+        print("daemon error: %s" % e, file=sys.stderr)
+        return None
+    if response is None:
+        return None
+    if 'error' in response:
+        print("daemon error: %s" % response['error'], file=sys.stderr)
+        return None
+    return Stats.from_dict(response['stats'])
 
 ############################################################
 
@@ -316,6 +2502,10 @@ if __name__ == '__main__':
     else:
         cmd = 'help'
 
+    if cmd == '--startup-bench':
+        budget = int(os.getenv('NOTSPAM_STARTUP_BUDGET', _STARTUP_BUDGET))
+        sys.exit(0 if startup_bench(budget) else 1)
+
     ########################################
 
     cname = os.getenv('NOTSPAM_CLASSIFIER', _DEFAULT_CLASSIFIER).lower()
@@ -328,6 +2518,14 @@ if __name__ == '__main__':
         elif cmd == 'retrain':
             retrain = True
         tags = []
+        batch_size = _DEFAULT_BATCH_SIZE
+        journal = True
+        checkpoint = _DEFAULT_CHECKPOINT
+        dedup = False
+        stream = False
+        window = None
+        via_daemon = False
+        stats_format = None
         dry = False
         argc = 2
         while True:
@@ -335,6 +2533,22 @@ if __name__ == '__main__':
                 break
             elif '--tags=' in sys.argv[argc]:
                 tags = sys.argv[argc].split('=',1)[1].split(',')
+            elif '--batch=' in sys.argv[argc]:
+                batch_size = int(sys.argv[argc].split('=',1)[1])
+            elif '--dedup' in sys.argv[argc]:
+                dedup = True
+            elif '--no-journal' in sys.argv[argc]:
+                journal = False
+            elif '--checkpoint=' in sys.argv[argc]:
+                checkpoint = int(sys.argv[argc].split('=',1)[1])
+            elif '--stream' in sys.argv[argc]:
+                stream = True
+            elif '--window=' in sys.argv[argc]:
+                window = int(sys.argv[argc].split('=',1)[1])
+            elif '--via-daemon' in sys.argv[argc]:
+                via_daemon = True
+            elif '--stats=' in sys.argv[argc]:
+                stats_format = _stats_format(sys.argv[argc].split('=',1)[1])
             elif '--dry' in sys.argv[argc]:
                 mname = 'null'
                 dry = True
@@ -352,19 +2566,48 @@ if __name__ == '__main__':
         if not query_string:
             sys.exit("Must specify search terms.")
 
-        module = _import_classifier(cname)
-        try:
-            msgs = _train(module, meat, query_string,
-                          tags=tags,
-                          retrain=retrain,
-                          dry=dry)
-        except KeyboardInterrupt:
-            sys.exit(-1)
+        stats = None
+        if via_daemon:
+            stats = _via_daemon('train', cname, query_string, meat=meat,
+                                tags=tags, retrain=retrain, dry=dry,
+                                batch_size=batch_size, dedup=dedup, stream=stream,
+                                window=window, journal=journal, checkpoint=checkpoint)
+            if stats:
+                _train_summary(stats, meat, retrain)
+        if stats is None:
+            module = _import_classifier(cname)
+            try:
+                stats = _train(module, meat, query_string,
+                               tags=tags,
+                               retrain=retrain,
+                               batch_size=batch_size,
+                               dedup=dedup,
+                               stream=stream,
+                               window=window,
+                               journal=journal,
+                               checkpoint=checkpoint,
+                               dry=dry)
+            except KeyboardInterrupt:
+                sys.exit(-1)
+        _print_stats(stats, stats_format)
 
     ########################################
     elif cmd in ['classify']:
         spam_tags = []
         ham_tags = []
+        unk_tags = []
+        batch_size = _DEFAULT_BATCH_SIZE
+        jobs = 1
+        shards = 1
+        cache = True
+        since_last_run = False
+        dedup = False
+        stream = False
+        window = None
+        prefilter = False
+        threads = None
+        via_daemon = False
+        stats_format = None
         dry = False
         argc = 2
         while True:
@@ -376,6 +2619,32 @@ if __name__ == '__main__':
                 ham_tags = sys.argv[argc].split('=',1)[1].split(',')
             elif '--unk=' in sys.argv[argc]:
                 unk_tags = sys.argv[argc].split('=',1)[1].split(',')
+            elif '--batch=' in sys.argv[argc]:
+                batch_size = int(sys.argv[argc].split('=',1)[1])
+            elif '--jobs=' in sys.argv[argc]:
+                jobs = int(sys.argv[argc].split('=',1)[1])
+            elif '--shards=' in sys.argv[argc]:
+                shards = int(sys.argv[argc].split('=',1)[1])
+            elif '--no-cache' in sys.argv[argc]:
+                cache = False
+            elif '--since-last-run' in sys.argv[argc]:
+                since_last_run = True
+            elif '--dedup' in sys.argv[argc]:
+                dedup = True
+            elif '--stream' in sys.argv[argc]:
+                stream = True
+            elif '--window=' in sys.argv[argc]:
+                window = int(sys.argv[argc].split('=',1)[1])
+            elif '--prefilter' in sys.argv[argc]:
+                prefilter = True
+            elif '--threads=' in sys.argv[argc]:
+                threads = sys.argv[argc].split('=',1)[1]
+            elif '--threads' in sys.argv[argc]:
+                threads = True
+            elif '--via-daemon' in sys.argv[argc]:
+                via_daemon = True
+            elif '--stats=' in sys.argv[argc]:
+                stats_format = _stats_format(sys.argv[argc].split('=',1)[1])
             elif '--dry' in sys.argv[argc]:
                 dry = True
             else:
@@ -386,13 +2655,103 @@ if __name__ == '__main__':
         if not query_string:
             sys.exit("Must specify search terms.")
 
+        kwargs = dict(spam_tags=spam_tags,
+                      ham_tags=ham_tags,
+                      unk_tags=unk_tags,
+                      batch_size=batch_size,
+                      jobs=jobs,
+                      shards=shards,
+                      cache=cache,
+                      since_last_run=since_last_run,
+                      dedup=dedup,
+                      stream=stream,
+                      window=window,
+                      prefilter=prefilter,
+                      threads=threads,
+                      dry=dry
+                  )
+        stats = None
+        if via_daemon:
+            stats = _via_daemon('classify', cname, query_string, **kwargs)
+            if stats:
+                _classify_summary(stats)
+        if stats is None:
+            module = _import_classifier(cname)
+            stats = _classify(module, query_string, **kwargs)
+        _print_stats(stats, stats_format)
+
+    ########################################
+    elif cmd in ['sync']:
+        spam_query = 'tag:spam'
+        ham_query = 'tag:ham'
+        batch_size = _DEFAULT_BATCH_SIZE
+        checkpoint = _DEFAULT_CHECKPOINT
+        stats_format = None
+        dry = False
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--spam=' in sys.argv[argc]:
+                spam_query = sys.argv[argc].split('=',1)[1]
+            elif '--ham=' in sys.argv[argc]:
+                ham_query = sys.argv[argc].split('=',1)[1]
+            elif '--batch=' in sys.argv[argc]:
+                batch_size = int(sys.argv[argc].split('=',1)[1])
+            elif '--checkpoint=' in sys.argv[argc]:
+                checkpoint = int(sys.argv[argc].split('=',1)[1])
+            elif '--stats=' in sys.argv[argc]:
+                stats_format = _stats_format(sys.argv[argc].split('=',1)[1])
+            elif '--dry' in sys.argv[argc]:
+                dry = True
+            else:
+                sys.exit("Unknown sync option '%s'." % sys.argv[argc])
+            argc += 1
+
         module = _import_classifier(cname)
-        _classify(module, query_string,
-                  spam_tags=spam_tags,
-                  ham_tags=ham_tags,
-                  unk_tags=unk_tags,
-                  dry=dry
-              )
+        stats = _sync(module, spam_query=spam_query, ham_query=ham_query,
+                      batch_size=batch_size, checkpoint=checkpoint, dry=dry)
+        _print_stats(stats, stats_format)
+
+    ########################################
+    elif cmd in ['evaluate']:
+        folds = _DEFAULT_FOLDS
+        backends = None
+        batch_size = _DEFAULT_BATCH_SIZE
+        jobs = 1
+        output = None
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--folds=' in sys.argv[argc]:
+                folds = int(sys.argv[argc].split('=',1)[1])
+            elif '--backends=' in sys.argv[argc]:
+                backends = sys.argv[argc].split('=',1)[1].split(',')
+            elif '--batch=' in sys.argv[argc]:
+                batch_size = int(sys.argv[argc].split('=',1)[1])
+            elif '--jobs=' in sys.argv[argc]:
+                jobs = int(sys.argv[argc].split('=',1)[1])
+            elif '--output=' in sys.argv[argc]:
+                output = sys.argv[argc].split('=',1)[1]
+            else:
+                break
+            argc += 1
+
+        if len(sys.argv) - argc != 2:
+            sys.exit("Must specify spam and ham search terms, each as one argument.")
+        spam_query, ham_query = sys.argv[argc:]
+
+        import json
+        report = evaluate(spam_query, ham_query, backends=backends, folds=folds,
+                          batch_size=batch_size, jobs=jobs)
+        _evaluate_summary(report)
+        report = json.dumps(report, indent=2, sort_keys=True) + '\n'
+        if output:
+            with open(output, 'w') as f:
+                f.write(report)
+        else:
+            sys.stdout.write(report)
 
     ########################################
     elif cmd in ['check']:
@@ -403,6 +2762,11 @@ if __name__ == '__main__':
         module = _import_classifier(cname)
         _classify(module, query_string, dry=True)
 
+    ########################################
+    elif cmd in ['serve']:
+        module = _import_classifier(cname)
+        serve(module)
+
     ########################################
     elif cmd in ['help','h','-h','--help']:
         _usage()
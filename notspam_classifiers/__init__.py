@@ -1,28 +1,175 @@
-import pkgutil
+import os
+import time
+import importlib
+import contextlib
+import collections
+
+# Built-in classifiers, by name.  Listed here rather than found by
+# scanning the package, so that listing them imports nothing.
+BUILTIN = {
+    'bogofilter': '.bogofilter',
+    'bsfilter': '.bsfilter',
+    'cascade': '.cascade',
+    'native': '.native',
+    'null': '.null',
+    'qsf': '.qsf',
+    'spamassassin': '.spamassassin',
+    'sylfilter': '.sylfilter',
+}
+
+# Third-party classifiers register a module under this entry point
+# group, e.g. in setup.py:
+#
+#   entry_points={'notspam.classifiers': ['mine = mypackage.mine']}
+ENTRY_POINT_GROUP = 'notspam.classifiers'
+
+_entry_points = None
+
+def _registered():
+    # entry point lookup scans all installed distributions, so it is
+    # only done when needed, and once per process
+    global _entry_points
+    if _entry_points is None:
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            _entry_points = {}
+            return _entry_points
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+        _entry_points = {ep.name: ep for ep in eps}
+    return _entry_points
 
 def classifiers_list():
-    clist = []
-    for finder, name, ispkg in pkgutil.iter_modules(__path__):
-        if ispkg:
-            continue
-        name = name.split('.')[-1]
-        if name[0] == '_':
-            continue
-        clist.append(name)
+    """List of available classifier names."""
+    clist = sorted(BUILTIN)
+    clist += sorted(name for name in _registered() if name not in BUILTIN)
     return clist
 
+def load_classifier(name):
+    """Import named classifier module.
+
+    Built-in classifiers take precedence over ones registered under
+    the 'notspam.classifiers' entry point group.  Raises ImportError
+    if there is no classifier by that name.
+
+    """
+    if name in BUILTIN:
+        return importlib.import_module(BUILTIN[name], package=__name__)
+    ep = _registered().get(name)
+    if ep is not None:
+        return ep.load()
+    # unlisted modules in the package, e.g. ones under development
+    return importlib.import_module('.'+name, package=__name__)
+
+def arg_chunks(args, cmd=[]):
+    """Split list of arguments into command-line sized chunks.
+
+    Yields lists of arguments from 'args' that, appended to command
+    'cmd', fit within the system's limit on the size of the argument
+    list and environment (ARG_MAX).
+
+    """
+    # each argument and environment string costs its length, a
+    # terminating null and a pointer
+    limit = os.sysconf('SC_ARG_MAX') - 4096
+    limit -= sum(len(k) + len(v) + 2 + 8 for k, v in os.environb.items())
+    limit -= sum(len(os.fsencode(a)) + 1 + 8 for a in cmd)
+    chunk = []
+    size = 0
+    for arg in args:
+        asize = len(os.fsencode(arg)) + 1 + 8
+        if chunk and size + asize > limit:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(arg)
+        size += asize
+    if chunk:
+        yield chunk
+
+def max_size():
+    """Most bytes of message body to classify, or None for no limit.
+
+    From NOTSPAM_MAX_SIZE, in kB (default: 512, 0 for no limit).
+
+    """
+    size = int(os.getenv('NOTSPAM_MAX_SIZE', 512)) * 1024
+    return size or None
+
+def timeout():
+    """Seconds to classify a message for, or None for no limit.
+
+    From NOTSPAM_TIMEOUT (default: 60, 0 for no limit).
+
+    """
+    return float(os.getenv('NOTSPAM_TIMEOUT', 60)) or None
+
+def read_message(path, size=None):
+    """Headers and at most 'size' bytes of body of message file.
+
+    Returns the tuple (data, truncated).  'size' defaults to
+    max_size().
+
+    """
+    if size is None:
+        size = max_size()
+    with open(path, 'rb') as f:
+        if size is None:
+            return f.read(), False
+        head = []
+        for line in f:
+            head.append(line)
+            if line in [b'\n', b'\r\n']:
+                break
+        body = f.read(size)
+        truncated = bool(f.read(1))
+    return b''.join(head) + body, truncated
+
+def _score(score):
+    try:
+        return float(score.split('/')[0])
+    except (AttributeError, ValueError):
+        return None
+
+def uncertain(result, band):
+    """True if (isspam, score) result is not confident.
+
+    That is, if it is unknown, or its score falls strictly inside the
+    (low, high) 'band'.  Scores of the form '<score>/<threshold>'
+    (spamassassin) are compared by <score>.  Without a band, only
+    unknown results are uncertain.  Used for cascade stages and
+    thread policies.
+
+    """
+    isspam, score = result
+    if isspam is None:
+        return True
+    if band is None:
+        return False
+    score = _score(score)
+    return score is not None and band[0] < score < band[1]
+
 ##################################################
 
 class NotspamTrainingError(Exception): pass
 class NotspamClassificationError(Exception): pass
+class NotspamTimeoutError(NotspamClassificationError): pass
 
 class NotspamTrainer(object):
     """Spam classification trainer
 
     """
-    def __init__(self, meat):
+    def __init__(self, meat, retrain=False):
         """Initialized with meat to train on, e.g. 'ham' or 'spam'.
 
+        If 'retrain' is True, the messages were previously trained as
+        the other meat, and that training should be undone if the
+        classifier supports it.
+
         """
         pass
 
@@ -34,16 +181,176 @@ class NotspamTrainer(object):
         """
         pass
 
+    def add_batch(self, messages):
+        """Add a list of messages to train as specified meat.
+
+        Passed a list of notmuch.message objects.  The default adds
+        each message in turn; trainers whose backend can take many
+        messages in a single invocation should override this.  Should
+        raise NotspamTrainingError if the batch failed.
+
+        """
+        for message in messages:
+            self.add(message)
+
     def sync(self):
         """Called after all messages have been added.
 
+        The trainer is not used again after it has been synced.
+
         """
         pass
 
 class NotspamClassifier(object):
     """Spam message classifier
 
+    A classifier may keep a 'counts' collections.Counter of its own
+    statistics (e.g. messages per stage), which are added to the
+    classification run statistics.
+
+    Classifiers running external programs should use run(), feed()
+    and bounded_paths(), which limit the size of message handed to
+    the program (see max_size()) and the time it may take (see
+    timeout()).  Messages that time out are classified as unknown;
+    the number of them and of truncated messages are kept in
+    'counts' as 'timeouts' and 'truncated'.
+
     """
+    counts = None
+
+    def count(self, key, n=1):
+        """Add 'n' to classifier's own count 'key'."""
+        if self.counts is None:
+            self.counts = collections.Counter()
+        self.counts[key] += n
+
+    def run(self, cmd, input=None, nmessages=1):
+        """Run command classifying 'nmessages' messages, with timeout.
+
+        Returns the tuple (returncode, stdout, stderr).  If the
+        command writes no output for timeout() seconds, it is killed
+        and NotspamTimeoutError raised.  Output is line buffered with
+        stdbuf, where available, so that for a command printing a
+        result line per message (e.g. 'sylfilter -t' with several
+        files) the timeout applies to each message, rather than a
+        batch taking up to timeout() times its size.
+
+        """
+        import shutil
+        import selectors
+        import subprocess
+        limit = timeout()
+        args = cmd
+        if shutil.which('stdbuf'):
+            args = ['stdbuf', '-oL'] + cmd
+        proc = subprocess.Popen(args,
+                                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                )
+        stdout = proc.stdout.fileno()
+        stderr = proc.stderr.fileno()
+        output = {stdout: [], stderr: []}
+        with selectors.DefaultSelector() as sel:
+            if input:
+                os.set_blocking(proc.stdin.fileno(), False)
+                sel.register(proc.stdin.fileno(), selectors.EVENT_WRITE)
+            elif input is not None:
+                proc.stdin.close()
+            for fd in output:
+                sel.register(fd, selectors.EVENT_READ)
+            deadline = limit and time.monotonic() + limit
+            while sel.get_map():
+                wait = deadline and max(deadline - time.monotonic(), 0)
+                events = sel.select(wait)
+                if not events:
+                    # the pipes are closed rather than drained, as
+                    # children of the command may still hold them open
+                    proc.kill()
+                    for f in [proc.stdin, proc.stdout, proc.stderr]:
+                        if f:
+                            f.close()
+                    proc.wait()
+                    # only count timeouts of single messages, as a
+                    # batch that times out is classified again message
+                    # by message
+                    if nmessages == 1:
+                        self.count('timeouts')
+                    raise NotspamTimeoutError("%s timed out" % cmd[0])
+                for key, mask in events:
+                    if mask & selectors.EVENT_WRITE:
+                        try:
+                            input = input[os.write(key.fd, input):]
+                        except BrokenPipeError:
+                            input = b''
+                        if not input:
+                            sel.unregister(key.fd)
+                            proc.stdin.close()
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fd)
+                        continue
+                    output[key.fd].append(chunk)
+                    if key.fd == stdout and limit:
+                        deadline = time.monotonic() + limit
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+        return proc.returncode, b''.join(output[stdout]), b''.join(output[stderr])
+
+    def feed(self, cmd, message):
+        """Run command with message on stdin (see run()).
+
+        At most max_size() bytes of the message body are fed.
+
+        """
+        try:
+            data, truncated = read_message(message.get_filename())
+        except OSError as e:
+            raise NotspamClassificationError(e)
+        if truncated:
+            self.count('truncated')
+        return self.run(cmd, input=data)
+
+    @contextlib.contextmanager
+    def bounded_paths(self, messages):
+        """Context manager giving file paths for list of messages.
+
+        Messages with more than max_size() bytes of body are replaced
+        by truncated copies in a temporary directory, which is
+        removed on exit.
+
+        """
+        def small(path):
+            # files that cannot be read are left for the classifier
+            # to report
+            try:
+                return os.path.getsize(path) <= size
+            except OSError:
+                return True
+        size = max_size()
+        paths = [message.get_filename() for message in messages]
+        if size is None or all(small(p) for p in paths):
+            yield paths
+            return
+        import tempfile
+        with tempfile.TemporaryDirectory(prefix='notspam-') as tmp:
+            for i, path in enumerate(paths):
+                if small(path):
+                    continue
+                try:
+                    data, truncated = read_message(path, size)
+                except OSError:
+                    continue
+                if not truncated:
+                    continue
+                self.count('truncated')
+                paths[i] = os.path.join(tmp, '%d-%s' % (i, os.path.basename(path)))
+                with open(paths[i], 'wb') as f:
+                    f.write(data)
+            yield paths
+
     def classify(self, message):
         """Classify a single message as spam or ham.
 
@@ -57,5 +364,141 @@ class NotspamClassifier(object):
         """
         return False, ''
 
+    def classify_batch(self, messages):
+        """Classify a list of messages as spam or ham.
+
+        Passed a list of notmuch.message objects.
+
+        Should return a list of (isspam, score) tuples, one for each
+        message and in the same order (see classify()).  Messages that
+        failed while others were classified may instead have a
+        NotspamClassificationError as their result.  The default
+        classifies each message in turn; classifiers whose backend can
+        handle many messages in a single invocation should override
+        this.
+
+        """
+        return [self.classify(message) for message in messages]
+
     def __call__(self, message):
         return self.classify(message)
+
+##################################################
+
+class Coprocess(object):
+    """Long-running classifier process fed message file paths.
+
+    For classifiers with a bulk mode that reads message file paths on
+    stdin, one per line, and writes a result line for each to stdout
+    (e.g. 'bogofilter -b -T').  The process is started on first use
+    and kept for later calls, so that its startup cost is paid once
+    rather than per message or batch.  If it fails or times out, it is
+    killed, and a new one started by the next call.
+
+    'parse' is called with each output line (without the newline),
+    and should return a (path, (isspam, score)) tuple, or None for
+    lines that are not results.  Output is line buffered with stdbuf,
+    where available, so that results are not held back in the
+    process's stdio buffers.
+
+    """
+    def __init__(self, cmd, parse):
+        self.cmd = cmd
+        self.parse = parse
+        self.proc = None
+
+    def _start(self):
+        import shutil
+        import subprocess
+        cmd = self.cmd
+        if shutil.which('stdbuf'):
+            cmd = ['stdbuf', '-oL'] + cmd
+        self.proc = subprocess.Popen(cmd,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     )
+        os.set_blocking(self.proc.stdin.fileno(), False)
+
+    def classify(self, paths, timeout=None):
+        """List of (isspam, score) results for list of paths.
+
+        Paths are written and results read concurrently, so that
+        neither side blocks on a full pipe.  If no result comes for
+        'timeout' seconds, NotspamTimeoutError is raised.
+
+        Results are expected in the order the paths were written.  A
+        path without a result (e.g. a file the process could not read,
+        for which bogofilter only complains on stderr) raises
+        NotspamClassificationError as soon as a later result shows it
+        was skipped, rather than after the timeout.
+
+        """
+        import selectors
+        for path in paths:
+            if not os.access(path, os.R_OK):
+                raise NotspamClassificationError("%s: cannot read %s" % (self.cmd[0], path))
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        stdin = self.proc.stdin.fileno()
+        stdout = self.proc.stdout.fileno()
+        data = bytes(''.join(p + '\n' for p in paths), 'UTF-8')
+        results = {}
+        nresults = 0
+        buf = b''
+        with selectors.DefaultSelector() as sel:
+            sel.register(stdin, selectors.EVENT_WRITE)
+            sel.register(stdout, selectors.EVENT_READ)
+            deadline = timeout and time.monotonic() + timeout
+            try:
+                while nresults < len(paths):
+                    wait = deadline and max(deadline - time.monotonic(), 0)
+                    events = sel.select(wait)
+                    if not events:
+                        raise NotspamTimeoutError("%s timed out" % self.cmd[0])
+                    for key, mask in events:
+                        if key.fd == stdin:
+                            data = data[os.write(stdin, data):]
+                            if not data:
+                                sel.unregister(stdin)
+                            continue
+                        chunk = os.read(stdout, 65536)
+                        if not chunk:
+                            raise NotspamClassificationError("%s exited" % self.cmd[0])
+                        *lines, buf = (buf + chunk).split(b'\n')
+                        for line in lines:
+                            result = self.parse(line.decode('UTF-8', 'replace'))
+                            if result is None:
+                                continue
+                            if result[0] != paths[nresults]:
+                                raise NotspamClassificationError(
+                                    "%s: no result for %s" % (self.cmd[0], paths[nresults]))
+                            results[result[0]] = result[1]
+                            nresults += 1
+                            if timeout:
+                                deadline = time.monotonic() + timeout
+            except (NotspamClassificationError, OSError) as e:
+                self.close(kill=True)
+                if isinstance(e, OSError):
+                    raise NotspamClassificationError("%s: %s" % (self.cmd[0], e))
+                raise
+        try:
+            return [results[path] for path in paths]
+        except KeyError as e:
+            raise NotspamClassificationError("%s: no result for %s" % (self.cmd[0], e))
+
+    def close(self, kill=False):
+        if self.proc is None:
+            return
+        if kill:
+            self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.proc = None
+
+    def __del__(self):
+        self.close()
@@ -3,7 +3,7 @@ from . import *
 import subprocess
 
 class Trainer(NotspamTrainer):
-    def __init__(self, meat):
+    def __init__(self, meat, retrain=False):
         self.cmd = ["mailreaver.crm"]
         if meat == 'spam':
             self.cmd += ['--spam']
@@ -24,19 +24,13 @@ class Trainer(NotspamTrainer):
 class Classifier(NotspamClassifier):
     def classify(self, msg):
         cmd = ["mailreaver.crm"]
-        with open(msg.get_filename(), 'r') as f:
-            proc = subprocess.Popen(cmd,
-                                    stdin=f,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    )
-            for line in proc.stdout:
-                line = line.decode().split()
-                if line[0] == 'X-CRM114-Status:':
-                    c = line[1]
-                    break
-            proc.communicate()
-            ret = proc.wait()
+        ret, stdout, stderr = self.feed(cmd, msg)
+        c = None
+        for line in stdout.decode().splitlines():
+            line = line.split()
+            if line and line[0] == 'X-CRM114-Status:':
+                c = line[1]
+                break
         if c == 'SPAM':
             isspam = True
         elif c == 'Good':
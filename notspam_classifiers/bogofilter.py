@@ -3,41 +3,71 @@ from . import *
 import subprocess
 
 class Trainer(NotspamTrainer):
-    def __init__(self, meat):
+    def __init__(self, meat, retrain=False):
         self.cmd = ["bogofilter"]
         if meat == 'spam':
+            if retrain:
+                self.cmd += ['-N']
             self.cmd += ['-s']
         elif meat == 'ham':
+            if retrain:
+                self.cmd += ['-S']
             self.cmd += ['-n']
 
     def add(self, msg):
-        with open(msg.get_filename(), 'r') as f:
-            subprocess.check_call(self.cmd,
-                                  stdin=f,
-                                  stdout=subprocess.DEVNULL,
-                                  stderr=subprocess.DEVNULL,
-                              )
+        try:
+            with open(msg.get_filename(), 'r') as f:
+                subprocess.check_call(self.cmd,
+                                      stdin=f,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL,
+                                  )
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise NotspamTrainingError('%s' % (e))
+
+    def add_batch(self, msgs):
+        # bulk mode: file names on stdin
+        paths = [msg.get_filename() for msg in msgs]
+        proc = subprocess.Popen(self.cmd + ['-b'],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE,
+                                )
+        (stdout, stderr) = proc.communicate(bytes(''.join(p + '\n' for p in paths), 'UTF-8'))
+        if proc.returncode != 0:
+            raise NotspamTrainingError('%s' % (stderr.decode()))
+
+def _parse_bulk(line):
+    # '<path> <c> <score>' line of bulk mode output
+    try:
+        path, c, score = line.rsplit(' ', 2)
+    except ValueError:
+        return None
+    if c == 'S':
+        isspam = True
+    elif c == 'H':
+        isspam = False
+    else:
+        isspam = None
+    return path, (isspam, score)
 
 class Classifier(NotspamClassifier):
+    def __init__(self):
+        # a single bogofilter in bulk mode, reading file names on
+        # stdin, for the lifetime of the classifier
+        self.coprocess = Coprocess(["bogofilter",
+                                    "-b",
+                                    "-T",
+                                    ], _parse_bulk)
+
     def classify(self, msg):
-        cmd = ["bogofilter",
-               "-T",
-               ]
-        with open(msg.get_filename(), 'r') as f:
-            proc = subprocess.Popen(cmd,
-                                    stdin=f,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    )
-            (stdout, stderr) = proc.communicate()
-            ret = proc.wait()
-        c, score = stdout.decode().strip().split(' ')
-        if ret == 0:
-            isspam = True
-        elif ret == 1:
-            isspam = False
-        elif ret == 2:
-            isspam = None
-        else:
-            raise NotspamClassifierFatalError()
-        return isspam, score
+        return self.classify_batch([msg])[0]
+
+    def classify_batch(self, msgs):
+        with self.bounded_paths(msgs) as paths:
+            try:
+                return self.coprocess.classify(paths, timeout=timeout())
+            except NotspamTimeoutError:
+                if len(msgs) == 1:
+                    self.count('timeouts')
+                raise
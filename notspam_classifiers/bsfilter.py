@@ -2,17 +2,36 @@ from . import *
 
 import subprocess
 
+# bsfilter default --spam-cutoff
+SPAM_CUTOFF = 0.9
+
 class Trainer(NotspamTrainer):
-    def __init__(self, meat):
+    def __init__(self, meat, retrain=False):
         self.cmd = ['bsfilter']
         if meat == 'spam':
+            if retrain:
+                self.cmd += ['-C']
             self.cmd += ['-s']
         elif meat == 'ham':
+            if retrain:
+                self.cmd += ['-S']
             self.cmd += ['-c']
 
     def add(self, msg):
-        self.cmd += msg.get_filename()
-        subprocess.call(self.cmd, stdout=subprocess.DEVNULL)
+        self.add_batch([msg])
+
+    def add_batch(self, msgs):
+        # as many files per invocation as fit on the command line; the
+        # database is updated once, in sync()
+        paths = [msg.get_filename() for msg in msgs]
+        for chunk in arg_chunks(paths, self.cmd):
+            proc = subprocess.Popen(self.cmd + chunk,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE,
+                                    )
+            (stdout, stderr) = proc.communicate()
+            if proc.returncode != 0:
+                raise NotspamTrainingError('%s' % (stderr.decode()))
 
     def sync(self):
         cmd = ['bsfilter', '--update']
@@ -20,15 +39,8 @@ class Trainer(NotspamTrainer):
 
 class Classifier(NotspamClassifier):
     def classify(self, msg):
-        cmd = ['bsfilter',
-               msg.get_filename(),
-               ]
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                )
-        (stdout, stderr) = proc.communicate()
-        ret = proc.wait()
+        with self.bounded_paths([msg]) as paths:
+            ret, stdout, stderr = self.run(['bsfilter'] + paths)
         try:
             score = stdout.decode().strip().split(' ')[4]
         except:
@@ -41,3 +53,27 @@ class Classifier(NotspamClassifier):
             # FIXME: raise error?
             isspam = None
         return isspam, score
+
+    def classify_batch(self, msgs):
+        # bsfilter prints a 'combined probability <path> <n> <score>'
+        # line for each file, but only returns a single exit status,
+        # so compare the scores against the spam cutoff ourselves.
+        stdout = stderr = b''
+        with self.bounded_paths(msgs) as paths:
+            for chunk in arg_chunks(paths, ['bsfilter']):
+                ret, out, err = self.run(['bsfilter'] + chunk, nmessages=len(chunk))
+                stdout += out
+                stderr += err
+        results = {}
+        for line in stdout.decode().splitlines():
+            try:
+                head, n, score = line.strip().rsplit(' ', 2)
+                path = head.split(' ', 2)[2]
+                isspam = float(score) > SPAM_CUTOFF
+            except (ValueError, IndexError):
+                continue
+            results[path] = (isspam, score)
+        try:
+            return [results[path] for path in paths]
+        except KeyError:
+            raise NotspamClassificationError('%s' % (stderr.decode()))
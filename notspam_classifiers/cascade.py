@@ -0,0 +1,135 @@
+"""Cascade of classifiers
+
+Runs a chain of other classifiers, cheapest first: each message is
+classified by the first stage, and only handed on to the next stage
+if that result is unknown, or its score falls inside the stage's
+uncertainty band.  The result of the last stage run is used.  If a
+stage fails (e.g. spamd is down), its messages go on to the next
+stage, and are only failed if no later stage classifies them.
+
+The chain is configured in NOTSPAM_CASCADE (default:
+bogofilter,spamassassin) as a comma-separated list of stages:
+
+  <classifier>[:<low>:<high>]
+
+where scores strictly between <low> and <high> are uncertain.  Scores
+of the form '<score>/<threshold>' (spamassassin) are compared by
+<score>.  Stages without a band only pass on unknown results, e.g.
+
+  NOTSPAM_CASCADE=bogofilter:0.1:0.9,spamassassin
+
+Training trains every stage.  The number of messages run through
+each stage is kept in Classifier.counts.  Results are cached under
+the stage spec (see cache_name()), and are invalidated by training
+the cascade or any of its stages (see models()).
+
+"""
+
+from . import *
+
+import os
+import collections
+
+DEFAULT_CASCADE = 'bogofilter,spamassassin'
+
+def stages(spec=None):
+    """List of (classifier name, band) stages from cascade spec.
+
+    'band' is a (low, high) tuple, or None.  The spec defaults to
+    NOTSPAM_CASCADE.
+
+    """
+    if spec is None:
+        spec = os.getenv('NOTSPAM_CASCADE', DEFAULT_CASCADE)
+    slist = []
+    for stage in spec.split(','):
+        name, *band = stage.strip().split(':')
+        if not name or name == 'cascade' or len(band) not in [0, 2]:
+            raise ValueError("bad cascade stage '%s'" % stage)
+        if band:
+            band = (float(band[0]), float(band[1]))
+        else:
+            band = None
+        slist.append((name, band))
+    return slist
+
+def models():
+    """Names of the stage classifiers, whose models the cascade uses."""
+    return [name for name, band in stages()]
+
+def cache_name():
+    """Name cascade results are cached under, including the stage spec."""
+    spec = []
+    for name, band in stages():
+        if band:
+            name += ':%g:%g' % band
+        spec.append(name)
+    return 'cascade:' + ','.join(spec)
+
+##################################################
+
+class Trainer(NotspamTrainer):
+    def __init__(self, meat, retrain=False):
+        self.trainers = [load_classifier(name).Trainer(meat, retrain=retrain)
+                         for name, band in stages()]
+
+    def add(self, msg):
+        for trainer in self.trainers:
+            trainer.add(msg)
+
+    def add_batch(self, msgs):
+        for trainer in self.trainers:
+            trainer.add_batch(msgs)
+
+    def sync(self):
+        for trainer in self.trainers:
+            trainer.sync()
+
+class Classifier(NotspamClassifier):
+    def __init__(self):
+        self.stages = [(name, band, load_classifier(name).Classifier())
+                       for name, band in stages()]
+        self.counts = collections.Counter()
+
+    def classify(self, msg):
+        result = self.classify_batch([msg])[0]
+        if isinstance(result, NotspamClassificationError):
+            raise result
+        return result
+
+    def classify_batch(self, msgs):
+        """Classify messages through the stages.
+
+        If a stage fails (e.g. spamd is down), the messages it was
+        given go on to the next stage, keeping the results of earlier
+        stages for all other messages.  Messages no later stage
+        classifies get the stage's NotspamClassificationError as their
+        result, so that they are not cached.
+
+        """
+        results = [None] * len(msgs)
+        todo = list(range(len(msgs)))
+        for name, band, classifier in self.stages:
+            if not todo:
+                break
+            before = collections.Counter(classifier.counts)
+            try:
+                sresults = classifier.classify_batch([msgs[i] for i in todo])
+            except NotspamClassificationError as e:
+                self.counts['%s.errors' % name] += 1
+                for i in todo:
+                    results[i] = e
+                continue
+            finally:
+                # stage's own counts, e.g. 'bogofilter.timeouts'
+                for key, n in (collections.Counter(classifier.counts) - before).items():
+                    self.counts['%s.%s' % (name, key)] += n
+            self.counts[name] += len(todo)
+            passed = []
+            for i, result in zip(todo, sresults):
+                isspam, score = result
+                results[i] = (isspam, '%s:%s' % (name, score) if score else name)
+                if uncertain(result, band):
+                    passed.append(i)
+            todo = passed
+        return results
@@ -0,0 +1,284 @@
+"""In-process Bayesian spam classifier
+
+A pure-Python classifier that needs no external programs.  Messages
+are tokenized straight from memory-mapped message files, and scored
+with Robinson's token probabilities combined with Fisher's method (as
+used by bogofilter and SpamBayes).
+
+Token counts are kept in a compact store of parallel sorted arrays of
+token hashes and spam/ham counts, which is loaded once per process
+and shared by all Classifier instances.  The store lives in
+NOTSPAM_NATIVE_DB (default: ~/.local/share/notspam/native.db).
+Training merges its counts into the store under a lock on
+<store>.lock, so that concurrent trainers do not lose each other's
+counts.
+
+"""
+
+from . import *
+
+import os
+import re
+import math
+import mmap
+import zlib
+import array
+import fcntl
+import bisect
+import struct
+import threading
+
+SPAM_CUTOFF = 0.9
+HAM_CUTOFF = 0.4
+# Robinson's strength of the background probability, and the
+# background probability itself
+ROBINSON_S = 1.0
+ROBINSON_X = 0.5
+# tokens with probabilities closer to 0.5 than this are ignored
+MIN_DEV = 0.1
+
+_TOKEN_RE = re.compile(rb"[A-Za-z0-9$'_-]{3,20}")
+_MAGIC = b'NSPM\x00\x00\x00\x01'
+_HEADER = struct.Struct('<8sQQQ')
+
+def _db_path():
+    path = os.getenv('NOTSPAM_NATIVE_DB')
+    if path:
+        return path
+    return os.path.join(os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share')),
+                        'notspam', 'native.db')
+
+def tokenize(path, size=None):
+    """Set of token hashes for message file.
+
+    Header tokens are hashed separately from body tokens, so that
+    e.g. a word in the Subject does not count as the same word in the
+    body.  The headers end at the first blank line, with LF or CRLF
+    line endings.  If 'size' is given, only that many bytes of the
+    body are tokenized.  Returns the tuple (tokens, truncated).
+
+    """
+    tokens = set()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return tokens, False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            ends = [i for i in (mm.find(b'\n\n'), mm.find(b'\r\n\r\n')) if i >= 0]
+            end = min(ends, default=len(mm))
+            stop = len(mm)
+            if size is not None:
+                stop = min(stop, end + size)
+            for match in _TOKEN_RE.finditer(mm, 0, end):
+                tokens.add(zlib.crc32(match.group().lower(), 1))
+            for match in _TOKEN_RE.finditer(mm, end, stop):
+                tokens.add(zlib.crc32(match.group().lower()))
+            truncated = stop < len(mm)
+    return tokens, truncated
+
+class TokenStore(object):
+    """Compact token count store.
+
+    Token hashes are kept in a sorted array, with the spam and ham
+    counts for each in parallel arrays.  'nspam' and 'nham' are the
+    number of messages trained as each.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.nspam = 0
+        self.nham = 0
+        self.hashes = array.array('I')
+        self.spam = array.array('I')
+        self.ham = array.array('I')
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            magic, self.nspam, self.nham, n = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise NotspamClassificationError("%s: not a token store" % path)
+            self.hashes.fromfile(f, n)
+            self.spam.fromfile(f, n)
+            self.ham.fromfile(f, n)
+
+    def lookup(self, hashes):
+        """Dict of (spam, ham) counts for iterable of token hashes.
+
+        Tokens are looked up in sorted order, so that each search
+        only needs to cover the remainder of the store.
+
+        """
+        counts = {}
+        lo = 0
+        n = len(self.hashes)
+        for h in sorted(hashes):
+            lo = bisect.bisect_left(self.hashes, h, lo)
+            if lo < n and self.hashes[lo] == h:
+                counts[h] = (self.spam[lo], self.ham[lo])
+        return counts
+
+    def update(self, deltas, nspam, nham):
+        """Merge dict of token (spam, ham) count deltas into store."""
+        hashes = array.array('I')
+        spam = array.array('I')
+        ham = array.array('I')
+        old = zip(self.hashes, self.spam, self.ham)
+        new = iter(sorted(deltas.items()))
+        o = next(old, None)
+        d = next(new, None)
+        while o is not None or d is not None:
+            if d is None or (o is not None and o[0] < d[0]):
+                h, s, m = o
+                o = next(old, None)
+            else:
+                h, (s, m) = d[0], d[1]
+                if o is not None and o[0] == h:
+                    s += o[1]
+                    m += o[2]
+                    o = next(old, None)
+                d = next(new, None)
+            s = max(s, 0)
+            m = max(m, 0)
+            if s or m:
+                hashes.append(h)
+                spam.append(s)
+                ham.append(m)
+        self.hashes, self.spam, self.ham = hashes, spam, ham
+        self.nspam = max(self.nspam + nspam, 0)
+        self.nham = max(self.nham + nham, 0)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, self.nspam, self.nham, len(self.hashes)))
+            self.hashes.tofile(f)
+            self.spam.tofile(f)
+            self.ham.tofile(f)
+        os.replace(tmp, self.path)
+
+    def probabilities(self, hashes):
+        """Dict of Robinson token spam probabilities f(w).
+
+        Tokens never seen in training are left out.
+
+        """
+        probs = {}
+        nspam = max(self.nspam, 1)
+        nham = max(self.nham, 1)
+        for h, (s, m) in self.lookup(hashes).items():
+            n = s + m
+            sratio = s / nspam
+            p = sratio / (sratio + m / nham)
+            probs[h] = (ROBINSON_S * ROBINSON_X + n * p) / (ROBINSON_S + n)
+        return probs
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _store():
+    # load the store once per process, and again only if it was
+    # changed on disk (e.g. by training)
+    path = _db_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    with _stores_lock:
+        cached = _stores.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, TokenStore(path))
+            _stores[path] = cached
+        return cached[1]
+
+def _chi2q(x2, v):
+    # probability that chi-squared with v (even) degrees of freedom
+    # is at least x2
+    m = x2 / 2.0
+    total = term = math.exp(-m)
+    for i in range(1, v // 2):
+        term *= m / i
+        total += term
+    return min(total, 1.0)
+
+def _score(tokens, probs):
+    probs = [probs[h] for h in tokens if h in probs]
+    probs = [p for p in probs if abs(p - 0.5) >= MIN_DEV]
+    if not probs:
+        return 0.5
+    n = len(probs)
+    hamminess = _chi2q(-2.0 * sum(math.log(p) for p in probs), 2 * n)
+    spamminess = _chi2q(-2.0 * sum(math.log1p(-p) for p in probs), 2 * n)
+    return (1.0 + hamminess - spamminess) / 2.0
+
+##################################################
+
+class Trainer(NotspamTrainer):
+    def __init__(self, meat, retrain=False):
+        # retraining moves the message from the other meat
+        if meat == 'spam':
+            self.delta = (1, -1 if retrain else 0)
+        elif meat == 'ham':
+            self.delta = (-1 if retrain else 0, 1)
+        self.deltas = {}
+        self.nspam = 0
+        self.nham = 0
+
+    def add(self, msg):
+        try:
+            tokens, truncated = tokenize(msg.get_filename())
+        except (OSError, ValueError) as e:
+            raise NotspamTrainingError(e)
+        ds, dh = self.delta
+        for h in tokens:
+            s, m = self.deltas.get(h, (0, 0))
+            self.deltas[h] = (s + ds, m + dh)
+        self.nspam += ds
+        self.nham += dh
+
+    def sync(self):
+        path = _db_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the store is replaced on save, so lock a separate file
+        # around the read-modify-write
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            store = TokenStore(path)
+            store.update(self.deltas, self.nspam, self.nham)
+            store.save()
+        self.deltas = {}
+        self.nspam = self.nham = 0
+
+class Classifier(NotspamClassifier):
+    def __init__(self):
+        self.store = _store()
+
+    def _result(self, score):
+        if score >= SPAM_CUTOFF:
+            isspam = True
+        elif score <= HAM_CUTOFF:
+            isspam = False
+        else:
+            isspam = None
+        return isspam, '%.6f' % score
+
+    def _tokenize(self, msg):
+        # no timeout applies in-process, but the size limit does
+        try:
+            tokens, truncated = tokenize(msg.get_filename(), max_size())
+        except (OSError, ValueError) as e:
+            raise NotspamClassificationError(e)
+        if truncated:
+            self.count('truncated')
+        return tokens
+
+    def classify(self, msg):
+        tokens = self._tokenize(msg)
+        return self._result(_score(tokens, self.store.probabilities(tokens)))
+
+    def classify_batch(self, msgs):
+        # look up every distinct token in the batch only once
+        tokens = [self._tokenize(msg) for msg in msgs]
+        probs = self.store.probabilities(set().union(*tokens))
+        return [self._result(_score(t, probs)) for t in tokens]
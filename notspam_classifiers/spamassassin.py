@@ -1,9 +1,20 @@
 from . import *
 
+import os
+import socket
+import getpass
+import threading
 import subprocess
+import concurrent.futures
+
+SPAMD_SOCKET = os.path.expanduser('~/.spamassassin/spamd')
+SPAMD_PORT = 783
+# maximum number of concurrent spamd connections
+CONNECTIONS = 4
 
 class Trainer(NotspamTrainer):
-    def __init__(self, meat):
+    def __init__(self, meat, retrain=False):
+        # sa-learn forgets any previous training of a message itself
         cmd = ['sa-learn',
                '--local',
                '--progress',
@@ -20,6 +31,10 @@ class Trainer(NotspamTrainer):
         path = msg.get_filename()
         self.__proc.stdin.write(bytes(path + '\n', 'UTF-8'))
 
+    def add_batch(self, msgs):
+        paths = [msg.get_filename() for msg in msgs]
+        self.__proc.stdin.write(bytes(''.join(p + '\n' for p in paths), 'UTF-8'))
+
     def sync(self):
         # run the learner
         self.__proc.communicate()
@@ -33,36 +48,166 @@ class Trainer(NotspamTrainer):
 
     ########################################################
 
+class SpamdClient(object):
+    """SPAMC protocol client for spamd.
+
+    Talks to spamd directly over a unix or TCP socket, rather than
+    forking spamc for every message.  'address' is either a unix
+    socket path or a (host, port) tuple.  At most 'connections'
+    requests are made to spamd concurrently.  Only the headers and
+    the first 'max_size' bytes of the body of larger messages are
+    sent.  Requests taking longer than 'timeout' seconds raise
+    NotspamTimeoutError.
+
+    """
+    def __init__(self, address, connections=CONNECTIONS, max_size=None, timeout=None):
+        self.address = address
+        self.connections = connections
+        self.max_size = max_size
+        self.timeout = timeout
+        self.user = getpass.getuser()
+        self.__slots = threading.BoundedSemaphore(connections)
+        # for checking batches of messages, shared by all callers
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+
+    def _connect(self):
+        # the timeout also bounds connecting, e.g. to a spamd host
+        # that has gone away
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(self.address)
+            except:
+                sock.close()
+                raise
+            return sock
+        return socket.create_connection(self.address, timeout=self.timeout)
+
+    def check(self, path):
+        """Check message file with spamd.
+
+        Returns the tuple (isspam, '<score>/<threshold>').
+
+        """
+        return self._check(path)[0]
+
+    def _check(self, path):
+        # check(), also returning whether the message was truncated
+        truncated = False
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            raise NotspamClassificationError(e)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            data = None
+            if self.max_size is not None and size > self.max_size:
+                data, truncated = read_message(path, self.max_size)
+                size = len(data)
+            with self.__slots:
+                try:
+                    with self._connect() as sock:
+                        sock.sendall(bytes('CHECK SPAMC/1.5\r\n'
+                                           'Content-length: %d\r\n'
+                                           'User: %s\r\n'
+                                           '\r\n' % (size, self.user), 'UTF-8'))
+                        if data is None:
+                            # stream the message straight from the file
+                            sock.sendfile(f)
+                        else:
+                            sock.sendall(data)
+                        sock.shutdown(socket.SHUT_WR)
+                        response = b''
+                        while True:
+                            data = sock.recv(4096)
+                            if not data:
+                                break
+                            response += data
+                except socket.timeout:
+                    raise NotspamTimeoutError('spamd timed out')
+                except OSError as e:
+                    raise NotspamClassificationError('spamd: %s' % e)
+        return self._parse(response.decode('UTF-8', 'replace')), truncated
+
+    def _check_batch(self, paths):
+        # _check() of each path, up to 'connections' at a time
+        return list(self.__executor.map(self._check, paths))
+
+    def _parse(self, response):
+        lines = response.split('\r\n')
+        status = lines[0].split(None, 2)
+        if len(status) < 2 or not status[0].startswith('SPAMD/'):
+            raise NotspamClassificationError('spamd: bad response: %r' % lines[0])
+        if status[1] != '0':
+            raise NotspamClassificationError('spamd: %s' % ' '.join(status[1:]))
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.lower() != 'spam':
+                continue
+            # Spam: True ; 15.0 / 5.0
+            try:
+                flag, result = value.split(';')
+                score, threshold = result.split('/')
+            except ValueError:
+                break
+            return flag.strip() == 'True', '%s/%s' % (score.strip(), threshold.strip())
+        raise NotspamClassificationError('spamd: no Spam header in response')
+
+def spamd_address():
+    """spamd address from NOTSPAM_SPAMD environment variable.
+
+    NOTSPAM_SPAMD may be a unix socket path or '<host>[:<port>]'.  If
+    not set, the per-user socket ~/.spamassassin/spamd is used if it
+    exists, or localhost:783 otherwise.
+
+    """
+    addr = os.getenv('NOTSPAM_SPAMD')
+    if not addr:
+        if os.path.exists(SPAMD_SOCKET):
+            return SPAMD_SOCKET
+        addr = 'localhost'
+    if '/' in addr:
+        return addr
+    host, _, port = addr.partition(':')
+    return (host, int(port or SPAMD_PORT))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _client():
+    # one client (and so one connection limit) per spamd address,
+    # shared by all classifier instances
+    address = spamd_address()
+    with _clients_lock:
+        if address not in _clients:
+            connections = int(os.getenv('NOTSPAM_SPAMD_CONNECTIONS', CONNECTIONS))
+            _clients[address] = SpamdClient(address, connections=connections,
+                                            max_size=max_size(), timeout=timeout())
+        return _clients[address]
+
 class Classifier(NotspamClassifier):
 
+    def __init__(self):
+        self.client = _client()
+
     def classify1(self, msg):
-        cmd = ["spamc",
-               "--socket=/home/jrollins/.spamassassin/spamd",
-               "--log-to-stderr",
-               "--max-size=5000000",
-               "--check",
-               ]
-        with open(msg.get_filename(), 'r') as f:
-            proc = subprocess.Popen(cmd,
-                                    stdin=f,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    )
-            (stdout, stderr) = proc.communicate()
-            ret = proc.wait()
-        score = stdout.decode().strip()
-        # process the return code.
-        # 1 == spam
-        # 0 == ham or error
-        #score, threshold = output.split('/')
-        if ret == 1:
-            isspam = True
-        else:
-            if score == '0/0':
-                isspam = None
-            else:
-                isspam = False
-        return isspam, score #'%s/%s' % (float(score), float(threshold))
+        try:
+            result, truncated = self.client._check(msg.get_filename())
+        except NotspamTimeoutError:
+            self.count('timeouts')
+            raise
+        if truncated:
+            self.count('truncated')
+        return result
+
+    def classify_batch(self, msgs):
+        paths = [msg.get_filename() for msg in msgs]
+        checked = self.client._check_batch(paths)
+        truncated = sum(1 for result, t in checked if t)
+        if truncated:
+            self.count('truncated', truncated)
+        return [result for result, t in checked]
 
     def classify2(self, msg):
         cmd = ['spamassassin',
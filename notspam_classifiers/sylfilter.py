@@ -25,6 +25,10 @@ class Trainer(NotspamTrainer):
         path = msg.get_filename()
         self.__proc.stdin.write(bytes(path + '\n', 'UTF-8'))
 
+    def add_batch(self, msgs):
+        paths = [msg.get_filename() for msg in msgs]
+        self.__proc.stdin.write(bytes(''.join(p + '\n' for p in paths), 'UTF-8'))
+
     def sync(self):
         # FIXME: why are we not catching errors here?
         self.__proc.communicate()
@@ -33,14 +37,8 @@ class Trainer(NotspamTrainer):
 class Classifier(NotspamClassifier):
 
     def classify(self, msg):
-        cmd = ['sylfilter',
-               '-t',
-               msg.get_filename(),
-               ]
-        ret = subprocess.call(cmd,
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL
-                              )
+        with self.bounded_paths([msg]) as paths:
+            ret, stdout, stderr = self.run(['sylfilter', '-t'] + paths)
         if ret == 0:
             isspam = True
         elif ret == 1:
@@ -51,3 +49,30 @@ class Classifier(NotspamClassifier):
             # FIXME: raise error
             isspam = None
         return isspam, None
+
+    def classify_batch(self, msgs):
+        # with several files sylfilter prints a '<path>: <status>' line
+        # for each, and the exit status only applies to the last one.
+        with self.bounded_paths(msgs) as paths:
+            cmd = ['sylfilter',
+                   '-t',
+                   ] + paths
+            ret, stdout, stderr = self.run(cmd, nmessages=len(paths))
+        results = {}
+        for line in stdout.decode().splitlines():
+            try:
+                path, status = line.rsplit(': ', 1)
+            except ValueError:
+                continue
+            status = status.split()[0].lower() if status.strip() else ''
+            if status in ['spam', 'junk']:
+                isspam = True
+            elif status in ['ham', 'clean']:
+                isspam = False
+            else:
+                isspam = None
+            results[path] = (isspam, None)
+        try:
+            return [results[path] for path in paths]
+        except KeyError:
+            raise NotspamClassificationError('%s' % (stderr.decode()))
@@ -0,0 +1,115 @@
+"""In-memory stand-in for the notmuch bindings, for tests.
+
+Understands just the queries notspam builds for searching by date:
+'*', 'tag:<tag>', 'id:<msgid>' and 'date:[@<time>]..[@<time>]' terms,
+joined with 'and' and grouped with parentheses.  Install it for a
+test with
+
+  unittest.mock.patch.dict(sys.modules, {'notmuch': fakenotmuch})
+
+"""
+
+class Query(object):
+    class SORT(object):
+        OLDEST_FIRST = 0
+        NEWEST_FIRST = 1
+        MESSAGE_ID = 2
+        UNSORTED = 3
+
+    def __init__(self, db, query_string):
+        self.db = db
+        self.query_string = query_string
+        self.sort = Query.SORT.NEWEST_FIRST
+        db.queries.append(query_string)
+
+    def set_sort(self, sort):
+        self.sort = sort
+
+    def _matches(self):
+        return [msg for msg in self.db.msgs if _match(msg, self.query_string)]
+
+    def count_messages(self):
+        return len(self._matches())
+
+    def search_messages(self):
+        msgs = self._matches()
+        if self.sort == Query.SORT.OLDEST_FIRST:
+            msgs.sort(key=lambda msg: msg.date)
+        elif self.sort == Query.SORT.NEWEST_FIRST:
+            msgs.sort(key=lambda msg: msg.date, reverse=True)
+        elif self.sort == Query.SORT.MESSAGE_ID:
+            msgs.sort(key=lambda msg: msg.msgid)
+        return iter(msgs)
+
+class Message(object):
+    def __init__(self, msgid, date, tags=(), path=None):
+        self.msgid = msgid
+        self.date = date
+        self.tags = set(tags)
+        self.path = path
+
+    def get_message_id(self):
+        return self.msgid
+
+    def get_date(self):
+        return self.date
+
+    def get_tags(self):
+        return iter(self.tags)
+
+    def get_filename(self):
+        return self.path
+
+class Database(object):
+    """Database of 'msgs', recording the query strings made in 'queries'."""
+    def __init__(self, msgs=()):
+        self.msgs = list(msgs)
+        self.queries = []
+
+    def create_query(self, query_string):
+        return Query(self, query_string)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def _split_and(query_string):
+    # top-level 'and' terms of query string
+    terms = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(query_string):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and query_string.startswith(' and ', i):
+            terms.append(query_string[start:i])
+            start = i + len(' and ')
+    terms.append(query_string[start:])
+    return [term.strip() for term in terms]
+
+def _time(value):
+    return int(value[1:]) if value else None
+
+def _match(msg, query_string):
+    terms = _split_and(query_string.strip())
+    if len(terms) > 1:
+        return all(_match(msg, term) for term in terms)
+    term = terms[0]
+    if term.startswith('(') and term.endswith(')'):
+        return _match(msg, term[1:-1])
+    if term == '*':
+        return True
+    prefix, _, value = term.partition(':')
+    if prefix == 'tag':
+        return value in msg.tags
+    if prefix == 'id':
+        return value == msg.msgid
+    if prefix == 'date':
+        start, end = [_time(v) for v in value.split('..')]
+        return ((start is None or msg.date >= start) and
+                (end is None or msg.date <= end))
+    raise ValueError("unsupported query term '%s'" % term)
@@ -0,0 +1,76 @@
+"""Tests for the cascade classifier, with fake stage classifiers."""
+
+import os
+import types
+import unittest
+
+from notspam_classifiers import NotspamClassifier, NotspamTimeoutError
+from notspam_classifiers import cascade
+
+class _Scored(NotspamClassifier):
+    # messages are scores; spam above 0.5
+    def classify(self, msg):
+        return msg > 0.5, '%g' % msg
+
+class _Down(NotspamClassifier):
+    calls = 0
+
+    def classify_batch(self, msgs):
+        _Down.calls += 1
+        raise NotspamTimeoutError('spamd down')
+
+    def classify(self, msg):
+        return self.classify_batch([msg])[0]
+
+STAGES = {
+    'scored': types.SimpleNamespace(Classifier=_Scored),
+    'down': types.SimpleNamespace(Classifier=_Down),
+}
+
+class CascadeTest(unittest.TestCase):
+    def setUp(self):
+        self.env = os.environ.get('NOTSPAM_CASCADE')
+        self.load_classifier = cascade.load_classifier
+        cascade.load_classifier = STAGES.__getitem__
+        _Down.calls = 0
+
+    def tearDown(self):
+        cascade.load_classifier = self.load_classifier
+        if self.env is None:
+            os.environ.pop('NOTSPAM_CASCADE', None)
+        else:
+            os.environ['NOTSPAM_CASCADE'] = self.env
+
+    def classifier(self, spec):
+        os.environ['NOTSPAM_CASCADE'] = spec
+        return cascade.Classifier()
+
+    def test_uncertain_passed_on(self):
+        classifier = self.classifier('scored:0.2:0.8,scored')
+        results = classifier.classify_batch([0.1, 0.5, 0.9])
+        self.assertEqual(results, [(False, 'scored:0.1'), (False, 'scored:0.5'),
+                                   (True, 'scored:0.9')])
+        self.assertEqual(classifier.counts['scored'], 4)
+
+    def test_failed_stage_keeps_results(self):
+        classifier = self.classifier('scored:0.2:0.8,down')
+        results = classifier.classify_batch([0.1, 0.5, 0.9])
+        self.assertEqual(results[0], (False, 'scored:0.1'))
+        self.assertIsInstance(results[1], NotspamTimeoutError)
+        self.assertEqual(results[2], (True, 'scored:0.9'))
+        self.assertEqual(_Down.calls, 1)
+        self.assertEqual(classifier.counts['down.errors'], 1)
+
+    def test_failed_stage_passes_on(self):
+        classifier = self.classifier('down,scored')
+        self.assertEqual(classifier.classify_batch([0.1, 0.9]),
+                         [(False, 'scored:0.1'), (True, 'scored:0.9')])
+
+    def test_classify_raises(self):
+        classifier = self.classifier('scored:0.2:0.8,down')
+        self.assertEqual(classifier.classify(0.9), (True, 'scored:0.9'))
+        with self.assertRaises(NotspamTimeoutError):
+            classifier.classify(0.5)
+
+if __name__ == '__main__':
+    unittest.main()
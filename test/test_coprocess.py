@@ -0,0 +1,115 @@
+"""Tests for Coprocess, with a fake bulk mode classifier process."""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from notspam_classifiers import Coprocess, NotspamClassificationError, NotspamTimeoutError
+
+# reads paths on stdin, and writes a '<path> <S|H> <score>' line for
+# each, like 'bogofilter -b -T'.  Files saying 'skip' get no result
+# line (as for files bogofilter can not read), 'hang' never gets one,
+# and 'exit' makes the process exit.
+BULK = r'''
+import sys, time
+print('starting up')
+for line in sys.stdin:
+    path = line.rstrip('\n')
+    data = open(path).read()
+    if 'skip' in data:
+        print('cannot read ' + path, file=sys.stderr)
+        continue
+    if 'hang' in data:
+        time.sleep(60)
+    if 'exit' in data:
+        sys.exit(1)
+    print('%s %s 0.5' % (path, 'S' if 'spam' in data else 'H'))
+'''
+
+def _parse(line):
+    try:
+        path, c, score = line.rsplit(' ', 2)
+    except ValueError:
+        return None
+    return path, (c == 'S', score)
+
+class CoprocessTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='notspam-test-')
+        self.coprocess = Coprocess([sys.executable, '-u', '-c', BULK], _parse)
+        self.nmsgs = 0
+
+    def tearDown(self):
+        self.coprocess.close(kill=True)
+        shutil.rmtree(self.tmp)
+
+    def message(self, data):
+        self.nmsgs += 1
+        path = os.path.join(self.tmp, 'msg%d' % self.nmsgs)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_results(self):
+        paths = [self.message('spam'), self.message('ham'), self.message('spam')]
+        self.assertEqual(self.coprocess.classify(paths),
+                         [(True, '0.5'), (False, '0.5'), (True, '0.5')])
+
+    def test_empty(self):
+        self.assertEqual(self.coprocess.classify([]), [])
+
+    def test_kept_between_calls(self):
+        self.coprocess.classify([self.message('ham')])
+        pid = self.coprocess.proc.pid
+        self.assertEqual(self.coprocess.classify([self.message('spam')]), [(True, '0.5')])
+        self.assertEqual(self.coprocess.proc.pid, pid)
+
+    def test_large_batch(self):
+        # more paths and results than fit in the pipe buffers
+        paths = [self.message('spam')] * 20000
+        self.assertEqual(self.coprocess.classify(paths, timeout=30), [(True, '0.5')] * 20000)
+
+    def test_unreadable(self):
+        paths = [self.message('ham'), os.path.join(self.tmp, 'missing')]
+        with self.assertRaisesRegex(NotspamClassificationError, 'cannot read'):
+            self.coprocess.classify(paths)
+        self.assertIsNone(self.coprocess.proc)
+
+    def test_missing_result(self):
+        skipped = self.message('skip')
+        paths = [self.message('ham'), skipped, self.message('spam')]
+        t = time.monotonic()
+        with self.assertRaisesRegex(NotspamClassificationError, 'no result for %s' % skipped):
+            self.coprocess.classify(paths, timeout=10)
+        self.assertLess(time.monotonic() - t, 5)
+        # the process is replaced by the next call
+        self.assertIsNone(self.coprocess.proc)
+        self.assertEqual(self.coprocess.classify([self.message('ham')]), [(False, '0.5')])
+
+    def test_missing_last_result(self):
+        # no later result shows the last path was skipped, so it
+        # times out
+        paths = [self.message('ham'), self.message('skip')]
+        with self.assertRaises(NotspamTimeoutError):
+            self.coprocess.classify(paths, timeout=0.5)
+        self.assertIsNone(self.coprocess.proc)
+
+    def test_timeout(self):
+        paths = [self.message('ham'), self.message('hang')]
+        t = time.monotonic()
+        with self.assertRaises(NotspamTimeoutError):
+            self.coprocess.classify(paths, timeout=0.5)
+        self.assertLess(time.monotonic() - t, 5)
+        self.assertIsNone(self.coprocess.proc)
+        self.assertEqual(self.coprocess.classify([self.message('spam')]), [(True, '0.5')])
+
+    def test_exited(self):
+        with self.assertRaisesRegex(NotspamClassificationError, 'exited'):
+            self.coprocess.classify([self.message('exit')], timeout=10)
+        self.assertEqual(self.coprocess.classify([self.message('spam')]), [(True, '0.5')])
+
+if __name__ == '__main__':
+    unittest.main()
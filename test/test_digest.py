@@ -0,0 +1,81 @@
+"""Tests for content_digest() of message files."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from notspam import content_digest
+
+MESSAGE = (b'From: someone@example.com\n'
+           b'Subject: hello\n'
+           b'Message-ID: <1@example.com>\n'
+           b'\n'
+           b'body\n'
+           b'\n'
+           b'more body\n')
+HEADERS = MESSAGE.split(b'\n\n')[0] + b'\n\n'
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='notspam-test-')
+        self.nmsgs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def digest(self, data):
+        self.nmsgs += 1
+        path = os.path.join(self.tmp, 'msg%d' % self.nmsgs)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return content_digest(path)
+
+    def test_same(self):
+        self.assertEqual(self.digest(MESSAGE), self.digest(MESSAGE))
+
+    def test_transport_headers(self):
+        delivered = (b'Return-Path: <someone@example.com>\n'
+                     b'Received: from mx.example.com\n'
+                     b'\tby mail.example.org; Mon, 1 Jan 2024 00:00:00 +0000\n'
+                     b'Delivered-To: me@example.org\n'
+                     b'X-Spam-Status: No, score=-1.0\n'
+                     b'X-CRM114-Status: Good\n') + MESSAGE
+        self.assertEqual(self.digest(delivered), self.digest(MESSAGE))
+
+    def test_header_case(self):
+        self.assertEqual(self.digest(b'RECEIVED: from x\n' + MESSAGE), self.digest(MESSAGE))
+
+    def test_content_headers(self):
+        self.assertNotEqual(self.digest(MESSAGE.replace(b'hello', b'hello!')),
+                            self.digest(MESSAGE))
+        # folded continuation lines belong to their header
+        self.assertNotEqual(self.digest(MESSAGE.replace(b'hello\n', b'hello\n world\n')),
+                            self.digest(MESSAGE))
+
+    def test_body(self):
+        self.assertNotEqual(self.digest(MESSAGE + b'x'), self.digest(MESSAGE))
+        # blank lines in the body are content
+        self.assertNotEqual(self.digest(MESSAGE.replace(b'body\n\n', b'body\n')),
+                            self.digest(MESSAGE))
+
+    def test_crlf(self):
+        self.assertEqual(self.digest(MESSAGE.replace(b'\n', b'\r\n')), self.digest(MESSAGE))
+
+    def test_crlf_chunk_boundary(self):
+        # the body is read 64k at a time, so this CRLF is split
+        # between reads
+        lf = HEADERS + b'x' * 65535 + b'\n' + b'y' * 10 + b'\n'
+        self.assertEqual(self.digest(lf.replace(b'\n', b'\r\n')), self.digest(lf))
+        # a lone CR is content
+        self.assertNotEqual(self.digest(MESSAGE + b'x\r'), self.digest(MESSAGE + b'x'))
+
+    def test_no_body(self):
+        self.assertEqual(self.digest(HEADERS[:-1]), self.digest(HEADERS))
+        self.assertNotEqual(self.digest(HEADERS), self.digest(MESSAGE))
+
+    def test_empty(self):
+        self.assertEqual(self.digest(b''), self.digest(b'\n'))
+
+if __name__ == '__main__':
+    unittest.main()
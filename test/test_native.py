@@ -0,0 +1,161 @@
+"""Tests for the in-process native classifier."""
+
+import os
+import zlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+from notspam_classifiers import native
+
+def _header(word):
+    return zlib.crc32(word, 1)
+
+def _body(word):
+    return zlib.crc32(word)
+
+class _Message(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_filename(self):
+        return self.path
+
+class _TempTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='notspam-test-')
+        self.nmsgs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def message(self, data):
+        self.nmsgs += 1
+        path = os.path.join(self.tmp, 'msg%d' % self.nmsgs)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+class TokenizeTest(_TempTest):
+    def test_headers_and_body(self):
+        tokens, truncated = native.tokenize(self.message(b'Subject: cheap pills\n\ncheap\n'))
+        self.assertEqual(tokens, {_header(b'subject'), _header(b'cheap'), _header(b'pills'),
+                                  _body(b'cheap')})
+        self.assertFalse(truncated)
+
+    def test_crlf(self):
+        lf, _ = native.tokenize(self.message(b'Subject: cheap pills\n\ncheap words\n'))
+        crlf, _ = native.tokenize(self.message(b'Subject: cheap pills\r\n\r\ncheap words\r\n'))
+        self.assertEqual(crlf, lf)
+        self.assertIn(_body(b'words'), crlf)
+
+    def test_no_body(self):
+        tokens, truncated = native.tokenize(self.message(b'Subject: hello'))
+        self.assertEqual(tokens, {_header(b'subject'), _header(b'hello')})
+
+    def test_case_and_length(self):
+        tokens, _ = native.tokenize(self.message(b'\n\nHELLO hello ab ' + b'x' * 30 + b'\n'))
+        # the 30 x's match as one 20 character token and one of 10
+        self.assertEqual(tokens, {_body(b'hello'), _body(b'x' * 20), _body(b'x' * 10)})
+
+    def test_size(self):
+        path = self.message(b'Subject: hello\n\nfirst second\n')
+        tokens, truncated = native.tokenize(path, size=7)
+        self.assertIn(_body(b'first'), tokens)
+        self.assertNotIn(_body(b'second'), tokens)
+        self.assertTrue(truncated)
+        tokens, truncated = native.tokenize(path, size=100)
+        self.assertIn(_body(b'second'), tokens)
+        self.assertFalse(truncated)
+
+    def test_empty(self):
+        self.assertEqual(native.tokenize(self.message(b'')), (set(), False))
+
+class TokenStoreTest(_TempTest):
+    def test_missing(self):
+        store = native.TokenStore(os.path.join(self.tmp, 'none.db'))
+        self.assertEqual((store.nspam, store.nham, len(store.hashes)), (0, 0, 0))
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp, 'sub', 'native.db')
+        store = native.TokenStore(path)
+        store.update({3: (1, 0), 1: (0, 2), 2: (1, 1)}, 2, 3)
+        store.save()
+        loaded = native.TokenStore(path)
+        self.assertEqual((loaded.nspam, loaded.nham), (2, 3))
+        self.assertEqual(list(loaded.hashes), [1, 2, 3])
+        self.assertEqual(loaded.lookup([3, 1, 4]), {1: (0, 2), 3: (1, 0)})
+
+    def test_update_merges(self):
+        store = native.TokenStore(os.path.join(self.tmp, 'native.db'))
+        store.update({1: (1, 0), 2: (1, 0)}, 1, 0)
+        # retraining as ham drops tokens whose counts reach zero
+        store.update({1: (-1, 1), 2: (-1, 0), 5: (0, 1)}, -1, 1)
+        self.assertEqual(list(store.hashes), [1, 5])
+        self.assertEqual(store.lookup([1, 2, 5]), {1: (0, 1), 5: (0, 1)})
+        self.assertEqual((store.nspam, store.nham), (0, 1))
+
+    def test_not_a_store(self):
+        path = self.message(b'x' * 64)
+        with self.assertRaises(native.NotspamClassificationError):
+            native.TokenStore(path)
+
+class ClassifierTest(_TempTest):
+    SPAM = [b'Subject: cheap pills\n\nbuy cheap pills now, viagra offer\n',
+            b'Subject: offer\n\ncheap viagra pills, limited offer\n',
+            b'Subject: winner\n\nclaim your prize, cheap pills offer\n']
+    HAM = [b'Subject: meeting\n\nthe meeting notes from today attached\n',
+           b'Subject: notes\n\nplease review the notes before the meeting\n',
+           b'Subject: lunch\n\nlunch after the meeting today?\n']
+
+    def setUp(self):
+        super().setUp()
+        self.env = os.environ.get('NOTSPAM_NATIVE_DB')
+        os.environ['NOTSPAM_NATIVE_DB'] = os.path.join(self.tmp, 'native.db')
+
+    def tearDown(self):
+        if self.env is None:
+            os.environ.pop('NOTSPAM_NATIVE_DB', None)
+        else:
+            os.environ['NOTSPAM_NATIVE_DB'] = self.env
+        super().tearDown()
+
+    def train(self, meat, corpus):
+        trainer = native.Trainer(meat)
+        trainer.add_batch([_Message(self.message(data)) for data in corpus])
+        trainer.sync()
+
+    def test_untrained(self):
+        msg = _Message(self.message(self.SPAM[0]))
+        self.assertEqual(native.Classifier().classify(msg), (None, '0.500000'))
+
+    def test_fisher(self):
+        self.train('spam', self.SPAM)
+        self.train('ham', self.HAM)
+        classifier = native.Classifier()
+        spam = _Message(self.message(b'Subject: offer\n\ncheap pills, viagra prize\n'))
+        ham = _Message(self.message(b'Subject: meeting\n\nnotes for the meeting today\n'))
+        self.assertEqual(classifier.classify(spam)[0], True)
+        self.assertEqual(classifier.classify(ham)[0], False)
+        self.assertEqual(classifier.classify_batch([spam, ham]),
+                         [classifier.classify(spam), classifier.classify(ham)])
+
+    def test_concurrent_sync(self):
+        # every trainer's counts end up in the store
+        trainers = []
+        for i in range(8):
+            trainer = native.Trainer('spam')
+            trainer.add(_Message(self.message(self.SPAM[0])))
+            trainers.append(trainer)
+        threads = [threading.Thread(target=trainer.sync) for trainer in trainers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store = native.TokenStore(os.environ['NOTSPAM_NATIVE_DB'])
+        self.assertEqual(store.nspam, 8)
+        self.assertEqual(store.lookup([_body(b'viagra')]), {_body(b'viagra'): (8, 0)})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for splitting searches into date range shards."""
+
+import sys
+import unittest
+from unittest import mock
+
+import notspam
+
+import fakenotmuch
+
+class ShardRangesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(sys.modules, {'notmuch': fakenotmuch})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def shards(self, dates, shards, search='*'):
+        db = fakenotmuch.Database(fakenotmuch.Message('id%d' % i, date, tags=['inbox'])
+                                  for i, date in enumerate(dates))
+        ranges = notspam._shard_ranges(db, search, shards)
+        # every message in the search is in exactly one range
+        counts = []
+        for r in ranges:
+            counts.append(db.create_query('(%s) and (%s)' % (search, r)).count_messages())
+        self.assertEqual(sum(counts), db.create_query(search).count_messages())
+        for msg in db.msgs:
+            if fakenotmuch._match(msg, search):
+                self.assertEqual(sum(fakenotmuch._match(msg, r) for r in ranges), 1)
+        return ranges, counts
+
+    def test_empty(self):
+        self.assertEqual(self.shards([], 4), (['date:..'], [0]))
+        self.assertEqual(self.shards([100, 200], 4, search='tag:none'), (['date:..'], [0]))
+
+    def test_one_shard(self):
+        self.assertEqual(self.shards(range(100, 110), 1), (['date:..'], [10]))
+
+    def test_single_date(self):
+        self.assertEqual(self.shards([100] * 10, 4), (['date:..'], [10]))
+
+    def test_single_message(self):
+        self.assertEqual(self.shards([100], 4), (['date:..'], [1]))
+
+    def test_even(self):
+        ranges, counts = self.shards(range(1000, 1100), 4)
+        self.assertEqual(counts, [25, 25, 25, 25])
+        self.assertEqual(ranges[0], 'date:..@1024')
+        self.assertEqual(ranges[-1], 'date:@1075..')
+
+    def test_uneven_dates(self):
+        # message counts, not time spans, are balanced
+        ranges, counts = self.shards(list(range(10)) + list(range(10**6, 10**6 + 30)), 2)
+        self.assertEqual(counts, [20, 20])
+
+    def test_ties(self):
+        # messages with the same date stay in the same shard, shards
+        # that would be empty are dropped, and the rest is still split
+        ranges, counts = self.shards([100] * 8 + [200, 300], 4)
+        self.assertEqual(counts, [8, 1, 1])
+
+    def test_more_shards_than_messages(self):
+        ranges, counts = self.shards([100, 200, 300], 8)
+        self.assertEqual(counts, [1, 1, 1])
+
+    def test_search(self):
+        # messages outside the search do not count
+        dates = [50] + list(range(100, 140)) + [500]
+        ranges, counts = self.shards(dates, 2, search='date:@100..@139')
+        self.assertEqual(counts, [20, 20])
+
+if __name__ == '__main__':
+    unittest.main()
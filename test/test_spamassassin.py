@@ -0,0 +1,201 @@
+"""Tests for the spamassassin classifier's spamd client.
+
+Run against a fake spamd on a unix socket, which records the requests
+it is sent and answers with canned responses:
+
+  python3 -m unittest discover -s test
+
+"""
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import socketserver
+
+from notspam_classifiers import NotspamClassificationError, NotspamTimeoutError
+from notspam_classifiers import spamassassin
+
+HEADERS = b'From: someone@example.com\nSubject: test\n\n'
+
+class _SpamdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline()
+        headers = {}
+        while True:
+            line = self.rfile.readline()
+            if line in [b'\r\n', b'']:
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = self.rfile.read(int(headers.get('content-length', 0)))
+        self.server.requests.append((request, headers, body))
+        time.sleep(self.server.latency)
+        try:
+            self.wfile.write(self.server.response)
+        except BrokenPipeError:
+            # the client gave up waiting
+            pass
+
+class FakeSpamd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Fake spamd recording requests, and answering with 'response'."""
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, path):
+        super().__init__(path, _SpamdHandler)
+        self.requests = []
+        self.response = b'SPAMD/1.1 0 EX_OK\r\nSpam: True ; 15.0 / 5.0\r\n\r\n'
+        self.latency = 0
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+class SpamdClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='notspam-test-')
+        self.spamd = FakeSpamd(os.path.join(self.tmp, 'spamd'))
+        self.client = spamassassin.SpamdClient(self.spamd.server_address, connections=2)
+
+    def tearDown(self):
+        self.spamd.shutdown()
+        self.spamd.server_close()
+        shutil.rmtree(self.tmp)
+
+    def message(self, body=b'hello\n'):
+        path = os.path.join(self.tmp, 'msg')
+        with open(path, 'wb') as f:
+            f.write(HEADERS + body)
+        return path
+
+    def test_request(self):
+        path = self.message()
+        self.client.check(path)
+        [(request, headers, body)] = self.spamd.requests
+        self.assertEqual(request, b'CHECK SPAMC/1.5\r\n')
+        self.assertEqual(int(headers['content-length']), os.path.getsize(path))
+        self.assertEqual(headers['user'], self.client.user)
+        self.assertEqual(body, HEADERS + b'hello\n')
+
+    def test_spam(self):
+        self.assertEqual(self.client.check(self.message()), (True, '15.0/5.0'))
+
+    def test_ham(self):
+        self.spamd.response = b'SPAMD/1.1 0 EX_OK\r\nSpam: False ; -1.2 / 5.0\r\n\r\n'
+        self.assertEqual(self.client.check(self.message()), (False, '-1.2/5.0'))
+
+    def test_spam_header_case(self):
+        self.spamd.response = (b'SPAMD/1.1 0 EX_OK\r\nContent-length: 0\r\n'
+                               b'spam:True;7/5\r\n\r\n')
+        self.assertEqual(self.client.check(self.message()), (True, '7/5'))
+
+    def test_error_status(self):
+        self.spamd.response = b'SPAMD/1.1 76 Bad header line: foo\r\n\r\n'
+        with self.assertRaisesRegex(NotspamClassificationError, '76 Bad header line'):
+            self.client.check(self.message())
+
+    def test_bad_response(self):
+        self.spamd.response = b'HTTP/1.1 400 Bad Request\r\n\r\n'
+        with self.assertRaisesRegex(NotspamClassificationError, 'bad response'):
+            self.client.check(self.message())
+
+    def test_no_spam_header(self):
+        self.spamd.response = b'SPAMD/1.1 0 EX_OK\r\nContent-length: 0\r\n\r\n'
+        with self.assertRaisesRegex(NotspamClassificationError, 'no Spam header'):
+            self.client.check(self.message())
+
+    def test_truncated(self):
+        self.client.max_size = 10
+        path = self.message(b'x' * 100)
+        result, truncated = self.client._check(path)
+        self.assertTrue(truncated)
+        [(request, headers, body)] = self.spamd.requests
+        self.assertEqual(body, HEADERS + b'x' * 10)
+        self.assertEqual(int(headers['content-length']), len(body))
+
+    def test_not_truncated(self):
+        self.client.max_size = 100
+        result, truncated = self.client._check(self.message(b'x' * 100))
+        self.assertFalse(truncated)
+        [(request, headers, body)] = self.spamd.requests
+        self.assertEqual(body, HEADERS + b'x' * 100)
+
+    def test_timeout(self):
+        self.client.timeout = 0.2
+        self.spamd.latency = 2
+        t = time.monotonic()
+        with self.assertRaises(NotspamTimeoutError):
+            self.client.check(self.message())
+        self.assertLess(time.monotonic() - t, 1.5)
+
+    def test_connect_timeout(self):
+        self.client.timeout = 0.2
+        with self.client._connect() as sock:
+            self.assertEqual(sock.gettimeout(), 0.2)
+        with socket.create_server(('127.0.0.1', 0)) as server:
+            client = spamassassin.SpamdClient(server.getsockname(), timeout=0.2)
+            with client._connect() as sock:
+                self.assertEqual(sock.gettimeout(), 0.2)
+
+    def test_batch(self):
+        paths = [self.message()] * 3
+        self.assertEqual(self.client._check_batch(paths), [((True, '15.0/5.0'), False)] * 3)
+        self.assertEqual(len(self.spamd.requests), 3)
+
+    def test_unreadable(self):
+        with self.assertRaises(NotspamClassificationError):
+            self.client.check(os.path.join(self.tmp, 'missing'))
+
+class ClassifierTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='notspam-test-')
+        self.spamd = FakeSpamd(os.path.join(self.tmp, 'spamd'))
+        self.env = {name: os.environ.get(name)
+                    for name in ['NOTSPAM_SPAMD', 'NOTSPAM_MAX_SIZE', 'NOTSPAM_TIMEOUT']}
+        os.environ['NOTSPAM_SPAMD'] = self.spamd.server_address
+        os.environ['NOTSPAM_MAX_SIZE'] = '1'
+        os.environ['NOTSPAM_TIMEOUT'] = '0.2'
+
+    def tearDown(self):
+        for name, value in self.env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        spamassassin._clients.pop(self.spamd.server_address, None)
+        self.spamd.shutdown()
+        self.spamd.server_close()
+        shutil.rmtree(self.tmp)
+
+    def messages(self, sizes):
+        msgs = []
+        for i, size in enumerate(sizes):
+            path = os.path.join(self.tmp, 'msg%d' % i)
+            with open(path, 'wb') as f:
+                f.write(HEADERS + b'x' * size)
+            msgs.append(_Message(path))
+        return msgs
+
+    def test_batch_counts_truncated(self):
+        classifier = spamassassin.Classifier()
+        results = classifier.classify_batch(self.messages([10, 2000, 3000]))
+        self.assertEqual(results, [(True, '15.0/5.0')] * 3)
+        self.assertEqual(classifier.counts['truncated'], 2)
+
+    def test_counts_timeouts(self):
+        self.spamd.latency = 2
+        classifier = spamassassin.Classifier()
+        with self.assertRaises(NotspamTimeoutError):
+            classifier.classify(self.messages([10])[0])
+        self.assertEqual(classifier.counts['timeouts'], 1)
+
+class _Message(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_filename(self):
+        return self.path
+
+if __name__ == '__main__':
+    unittest.main()
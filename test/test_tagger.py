@@ -0,0 +1,92 @@
+"""Tests for Tagger tag diffing and atomic sections."""
+
+import unittest
+
+from notspam import Tagger
+
+class _Database(object):
+    def __init__(self):
+        self.calls = []
+
+    def begin_atomic(self):
+        self.calls.append('begin')
+
+    def end_atomic(self):
+        self.calls.append('end')
+
+class _Message(object):
+    def __init__(self, tags):
+        self.tags = set(tags)
+        self.calls = []
+
+    def get_tags(self):
+        return iter(self.tags)
+
+    def freeze(self):
+        self.calls.append('freeze')
+
+    def thaw(self):
+        self.calls.append('thaw')
+
+    def add_tag(self, tag):
+        self.calls.append('+' + tag)
+        self.tags.add(tag)
+
+    def remove_tag(self, tag):
+        self.calls.append('-' + tag)
+        self.tags.discard(tag)
+
+class DiffTest(unittest.TestCase):
+    def diff(self, current, tags):
+        return Tagger.diff(_Message(current), tags)
+
+    def test_add_remove(self):
+        self.assertEqual(self.diff(['inbox', 'new'], ['+spam', '-inbox']),
+                         ({'spam'}, {'inbox'}))
+
+    def test_bare_tag_adds(self):
+        self.assertEqual(self.diff([], ['spam']), ({'spam'}, set()))
+
+    def test_no_op(self):
+        self.assertEqual(self.diff(['spam'], ['+spam', '-ham']), (set(), set()))
+        self.assertEqual(self.diff(['spam'], []), (set(), set()))
+
+    def test_in_order(self):
+        # later changes to the same tag win
+        self.assertEqual(self.diff(['inbox'], ['+spam', '-spam']), (set(), set()))
+        self.assertEqual(self.diff(['inbox'], ['-inbox', '+inbox']), (set(), set()))
+        self.assertEqual(self.diff([], ['-spam', '+spam']), ({'spam'}, set()))
+
+class TagTest(unittest.TestCase):
+    def test_unchanged_not_touched(self):
+        db = _Database()
+        msg = _Message(['spam'])
+        tagger = Tagger(db)
+        self.assertFalse(tagger.tag(msg, ['+spam', '-ham']))
+        self.assertFalse(tagger.tag(msg, []))
+        tagger.flush()
+        self.assertEqual((db.calls, msg.calls, tagger.nchanged), ([], [], 0))
+
+    def test_changed(self):
+        db = _Database()
+        msg = _Message(['inbox'])
+        with Tagger(db) as tagger:
+            self.assertTrue(tagger.tag(msg, ['+spam', '-inbox']))
+        self.assertEqual(msg.tags, {'spam'})
+        self.assertEqual(msg.calls, ['freeze', '-inbox', '+spam', 'thaw'])
+        self.assertEqual(db.calls, ['begin', 'end'])
+        self.assertEqual(tagger.nchanged, 1)
+
+    def test_atomic_sections(self):
+        db = _Database()
+        msgs = [_Message([]) for i in range(5)]
+        with Tagger(db, atomic_size=2) as tagger:
+            for msg in msgs:
+                tagger.tag(msg, ['+spam'])
+            # an unchanged message does not open a section
+            tagger.tag(msgs[0], ['+spam'])
+        self.assertEqual(db.calls, ['begin', 'end'] * 3)
+        self.assertEqual(tagger.nchanged, 5)
+
+if __name__ == '__main__':
+    unittest.main()
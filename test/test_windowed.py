@@ -0,0 +1,69 @@
+"""Tests for iterating over searches in windows."""
+
+import sys
+import unittest
+from unittest import mock
+
+import notspam
+
+import fakenotmuch
+
+class WindowedTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(sys.modules, {'notmuch': fakenotmuch})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def windowed(self, dates, window, search='*'):
+        self.db = fakenotmuch.Database(fakenotmuch.Message('id%d' % i, date)
+                                       for i, date in enumerate(dates))
+        msgs = list(notspam._windowed(self.db, search, window))
+        # every message in the search once, oldest first
+        self.assertEqual(sorted(msg.get_message_id() for msg in msgs),
+                         sorted(msg.get_message_id() for msg in self.db.msgs
+                                if fakenotmuch._match(msg, search)))
+        dates = [msg.get_date() for msg in msgs]
+        self.assertEqual(dates, sorted(dates))
+        return msgs
+
+    def test_empty(self):
+        self.assertEqual(self.windowed([], 10), [])
+        self.assertEqual(len(self.db.queries), 1)
+
+    def test_one_window(self):
+        self.windowed(range(10), 10)
+        self.assertEqual(self.db.queries, ['*'])
+
+    def test_windows(self):
+        self.windowed(range(100, 125), 10)
+        # a new query from the date of the last message of each window
+        self.assertEqual(self.db.queries,
+                         ['*', '(*) and (date:@109..)', '(*) and (date:@119..)'])
+
+    def test_window_of_one(self):
+        self.windowed(range(100, 105), 1)
+        self.assertEqual(len(self.db.queries), 5)
+
+    def test_same_date_runs_over(self):
+        # a window only ends between messages with different dates
+        self.windowed([100] * 7 + [200] * 7 + [300], 3)
+        self.assertEqual(self.db.queries,
+                         ['*', '(*) and (date:@100..)', '(*) and (date:@200..)'])
+
+    def test_single_date(self):
+        self.windowed([100] * 10, 3)
+        self.assertEqual(len(self.db.queries), 1)
+
+    def test_boundary_date(self):
+        # the window fills up in the middle of a date, which the next
+        # window starts from without repeating its messages
+        self.windowed([100, 101, 101, 102, 102, 102, 103], 2)
+        self.windowed([100, 101, 101, 101, 102], 2)
+
+    def test_search(self):
+        msgs = self.windowed(range(100, 150), 7, search='date:@120..@139')
+        self.assertEqual(len(msgs), 20)
+        self.assertTrue(all(q.startswith('(date:@120..@139)') for q in self.db.queries[1:]))
+
+if __name__ == '__main__':
+    unittest.main()